@@ -20,10 +20,11 @@
 
 import logging
 from cliff.command import Command
-import pickle
 
 from .systemutils import read_config, enable_authconfig, disable_authconfig
 from .shellaccount import ShellAccounts
+from .sync import AccountSync
+from .policy import HostPolicy
 
 
 class Install(Command):
@@ -86,6 +87,14 @@ class Install(Command):
             default=False,
             help='Always use metadata from FAS server, skipping local cache.',
         )
+        parser.add_argument(
+            '--full',
+            dest='full',
+            action='store_true',
+            default=False,
+            help='Sweep every account instead of the ones changed since the '
+                 'last run.',
+        )
         parser.add_argument(
             '-NS', '--no-session',
             dest='nosession',
@@ -100,48 +109,26 @@ class Install(Command):
         config = read_config(self.app_args.configfile)
         temp = config.get('global', 'temp').strip('"')
 
-        groups = config.get('host', 'groups').strip('"').split(',')
-        restricted_groups = config.get('host', 'restricted_groups').strip(
-            '"').split(',')
-
         sa = ShellAccounts(prefix=args.prefix, tempdir=temp,
                            base_url=self.app_args.fas_server,
-                           token_api=config.get('global', 'tokenapi'))
-        users = sa.filter_users(valid_groups=groups,
-                                restricted_groups=restricted_groups)
-
-        # Required actions
-        sa.make_group_db(users, 'group', args.nogroup)
-        sa.make_passwd_db(users, 'passwd', 'shadow', args.nopasswd, args.noshadow)
-
-        if not args.nohome:
-            try:
-                modefile = open(config.get('global', 'modefile'), 'r')
-                modes = pickle.load(modefile)
-            except IOError, e:
-                modes = {}
-                self.log.debug('Unable to read from file: %s' % e)
-            else:
-                modefile.close()
-            sa.create_home_dirs(users, modes=modes)
-            new_modes = sa.remove_stale_homedirs(users)
-            modes.update(new_modes)
-            try:
-                modefile = open(config.get('global', 'modefile'), 'w')
-                pickle.dump(modes, modefile)
-            except IOError:
-                pass
-            else:
-                modefile.close()
-
+                           token_api=config.get('global', 'tokenapi'),
+                           policy=HostPolicy.from_config(config, args.prefix),
+                           config=config,
+                           force_refresh=args.refresh)
+
+        AccountSync(sa, config).run(home=not args.nohome,
+                                    ssh=not args.nossh,
+                                    install_group=args.nogroup,
+                                    install_passwd=args.nopasswd,
+                                    install_shadow=args.noshadow,
+                                    full=args.full)
+
+        # Enabled once the databases it points NSS to are installed.
         if args.noauth:
             disable_authconfig()
         else:
             enable_authconfig()
 
-        if not args.nossh:
-            sa.create_ssh_keys(users)
-
 
 class Sync(Command):
     """ Synchronize FAS's account with your local shell account. """
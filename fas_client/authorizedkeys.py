@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import sys
+import logging
+
+from cliff.command import Command
+
+from .systemutils import read_config, get_option
+from .keyindex import INDEX, lookup
+
+
+class AuthorizedKeys(Command):
+    """ Prints a user's SSH keys, for sshd's AuthorizedKeysCommand. """
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(type(self), self).get_parser(prog_name)
+        parser.add_argument('username', help='FAS login')
+        return parser
+
+    def take_action(self, args):
+        config = read_config(self.app_args.configfile)
+        index = get_option(config, 'global', 'key_index', INDEX)
+
+        try:
+            keys = lookup(index, args.username)
+        except (IOError, OSError), e:
+            self.log.error('Unable to read %s: %s' % (index, e))
+            sys.exit(1)
+        # The keys are bytes, cliff's stdout would decode them as ASCII.
+        for key in keys:
+            sys.stdout.write(key + '\n')
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import os
+import json
+import time
+import logging
+
+from fedora.client import FedoraServiceError
+from path import path
+
+from .systemutils import atomic_write
+
+
+class DataCache(object):
+    """
+    On-disk cache of the payloads fetched from FAS.
+
+    Payloads younger than ttl seconds are served from disk. Older ones are
+    fetched again, and the last good payload is used when FAS cannot be
+    reached. Files are only readable by their owner since they hold password
+    hashes.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, directory, ttl=0):
+        self.directory = path(directory)
+        self.ttl = ttl
+
+    def filename(self, name):
+        return self.directory.joinpath('fas-%s.json' % name)
+
+    def age(self, name):
+        """ Returns the age in seconds of the cached payload or None. """
+        try:
+            return time.time() - self.filename(name).mtime
+        except OSError:
+            return None
+
+    def load(self, name):
+        """ Returns the cached payload or None. """
+        try:
+            with open(self.filename(name), 'rb') as cachefile:
+                return json.load(cachefile)
+        except (IOError, ValueError), e:
+            self.log.debug('Unable to read from cache: %s' % e)
+            return None
+
+    def store(self, name, data):
+        """ Atomically replaces the cached payload. """
+        try:
+            if not self.directory.access(os.F_OK):
+                os.makedirs(self.directory)
+            atomic_write(self.filename(name),
+                         lambda cachefile: json.dump(data, cachefile))
+        except (IOError, OSError), e:
+            self.log.warning('Unable to write to cache: %s' % e)
+
+    def get(self, name, fetch, force=False):
+        """
+        Returns the payload called name, calling fetch() to retrieve it from
+        FAS when the cached one is missing, expired or force is set.
+        """
+        age = self.age(name)
+        if not force and age is not None and age < self.ttl:
+            data = self.load(name)
+            if data is not None:
+                self.log.debug('Using cached %s (%is old)' % (name, age))
+                return data
+
+        try:
+            data = fetch()
+        except FedoraServiceError, e:
+            data = self.load(name)
+            if data is None:
+                raise
+            self.log.warning('Unable to fetch %s from FAS (%s), using cached '
+                             'data from %is ago' % (name, e, age))
+            return data
+
+        self.store(name, data)
+        return data
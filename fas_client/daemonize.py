@@ -18,96 +18,309 @@
 #
 # Author(s): Xavier Lamien <laxathom@fedoraproject.org>
 
+import socket
 import logging
-import sys, signal, time
+import signal
+import ConfigParser
 from cliff.command import Command
 
-from .systemutils import read_config, enable_authconfig, disable_authconfig
+from .systemutils import (read_config, enable_authconfig, disable_authconfig,
+                          get_option)
 from .shellaccount import ShellAccounts
+from .sync import AccountSync
+from .policy import HostPolicy
 from .accountsetup import Install
+from .scheduler import CoalescingScheduler, RECONCILE, REFRESH_USERS, \
+    make_event
+from .receiver import MessageReceiver
+from .routing import Router
+from .metrics import metrics
+from .replay import (Checkpoint, MessageHistory, ReplayGap, load_checkpoint,
+                     save_checkpoint)
 
 import fedmsg
 
-config = read_config()
+
 class Daemonize(Command):
     """ Runs fas-client as a daemon. """
 
     log = logging.getLogger(__name__)
 
+    config = None
+    policy = None
+    sa = None
+    sync = None
+    scheduler = None
+    receiver = None
+    stopping = False
+    reloading = False
+    reconnect = False
+    replaying = False
+
     def sig_handler(self, signum = None, frame = None):
         self.log.info('\nCaught signal %s from signals handler' % signum)
 
-        time.sleep(1)  #here check if process is done
-        sys.exit(0)
-
-    def update_account(self):
-        """ Updates FAS account on your local system"""
-        sa = ShellAccounts(prefix='/',
-                           tempdir=config.get('global', 'temp').strip('"'),
-                           base_url=config.get('global', 'url').strip('"'),
-                           token_api=config.get('global', 'tokenapi').strip('"')
-                           )
-         
-        groups = []
-        groups = config.get('host', 'groups').strip('"').split(',')
-        restricted_groups = []
-        restricted_groups = config.get('host', 'restricted_groups').strip('"').split(',')
-        users = sa.filter_users(valid_groups=groups,
-                              restricted_groups=restricted_groups)
-
-        sa.make_group_db(users, 'group')
-        sa.make_passwd_db(users, 'passwd', 'shadow')
+        # Acted upon by the main loop, between two waits on the receiver.
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
 
-        try:
-            modefile = open(config.get('global', 'modefile'), 'r')
-            modes = pickle.load(modefile)
-        except IOError, e:
-            modes = {}
-            self.log.debug('Unable to read from file: %s' % e)
+    def configure(self):
+        """ Applies the configuration to the running daemon. """
+        config = self.config
+        self.policy = HostPolicy.from_config(config)
+        self.receiver.classify = Router.for_policy(self.policy).route
+        self.scheduler.configure(
+            get_option(config, 'daemon', 'quiet_window', 5, kind='float'),
+            get_option(config, 'daemon', 'max_delay', 60, kind='float'),
+            get_option(config, 'daemon', 'queue_size', 1000, kind='int'))
+
+        interval = get_option(config, 'daemon', 'reconcile_interval', 3600,
+                              kind='float')
+        if interval:
+            self.scheduler.reconcile_every(
+                interval,
+                get_option(config, 'daemon', 'reconcile_jitter', interval / 10,
+                           kind='float'),
+                get_option(config, 'daemon', 'max_staleness', None,
+                           kind='float'),
+                last=self.scheduler.reconciled or self.last_complete_sync())
         else:
-            modefile.close()
+            self.scheduler.reconcile_every(None)
+
+    @property
+    def statefile(self):
+        """ Returns where the last applied message is recorded. """
+        return get_option(self.config, 'daemon', 'statefile',
+                          '/var/lib/fas/client_daemon_state')
+
+    def checkpoint(self, checkpoint):
+        """ Records the last message applied. """
+        try:
+            save_checkpoint(self.statefile, checkpoint)
+        except (IOError, OSError), e:
+            self.log.warning('Unable to save the last applied message: %s'
+                             % e)
 
-        sa.create_home_dirs(users, modes=modes)
-        new_modes = sa.remove_stale_homedirs(users)
-        modes.update(new_modes)
+    def catch_up(self):
+        """
+        Replays the FAS messages sent while the daemon was not running, from
+        [daemon] history_url. A full sync is run instead when they are too
+        old or too many.
+        """
+        url = get_option(self.config, 'daemon', 'history_url', '')
+        checkpoint = load_checkpoint(self.statefile)
+        if not url or checkpoint is None:
+            return
 
+        history = MessageHistory(
+            url,
+            max_age=get_option(self.config, 'daemon', 'max_replay_age', 86400,
+                               kind='float'),
+            max_messages=get_option(self.config, 'daemon',
+                                    'max_replay_messages', 10000, kind='int'))
+        # Syncs must not record a checkpoint past what is not replayed yet.
+        self.replaying = True
         try:
-            modefile = open(config.get('global', 'modefile'), 'w')
-            pickle.dump(modes, modefile)
-        except IOError:
-            pass
+            count = 0
+            for topic, msg in history.messages(checkpoint):
+                if self.stopping:
+                    # Left unfinished, the next start replays it again.
+                    return
+                count += self.receiver.handle(topic, msg, live=False)
+            self.log.info('Replayed %i missed FAS updates' % count)
+        except ReplayGap, e:
+            self.log.warning('Unable to replay missed FAS updates (%s), '
+                             'running a full sync' % e)
+            self.scheduler.submit(make_event(RECONCILE))
+        self.replaying = False
+
+    def last_complete_sync(self):
+        """ Returns when the last complete sync of the host started. """
+        self.connect()
+        return self.sync.lock.last_start()
+
+    def reload(self):
+        """
+        Reads the configuration file again. Accounts are set up anew from
+        the next sync on; changing the topic needs a restart.
+
+        The current configuration is kept when the file cannot be read or
+        applied.
+        """
+        filename = self.app_args.configfile
+        self.log.info('Reloading %s' % filename)
+        previous = self.config
+        try:
+            # read_config() exits when the file is missing or malformed.
+            self.config = read_config(filename)
+            self.configure()
+        except (ConfigParser.Error, ValueError, SystemExit), e:
+            self.log.error('Unable to reload %s, keeping the current '
+                           'configuration: %r' % (filename, e))
+            self.config = previous
+            self.configure()
+            return
+        # Set up again by the sync thread, between two syncs.
+        self.reconnect = True
+
+    def shutdown(self):
+        """
+        Stops taking FAS updates and lets the pending ones be applied,
+        within [daemon] shutdown_timeout seconds.
+        """
+        timeout = get_option(self.config, 'daemon', 'shutdown_timeout', 30,
+                             kind='float')
+        self.log.info('Shutting down, waiting up to %is for syncs to finish'
+                      % timeout)
+        self.receiver.stop()
+        if not self.scheduler.stop(timeout):
+            # The snapshot and checkpoint of the last finished sync are
+            # kept, so the next start picks up from there.
+            self.log.warning('Syncs still running or failed after %is, '
+                             'exiting anyway' % timeout)
+        elif self.receiver.last and self.receiver.last[1] \
+                and not self.replaying:
+            # Every message received was applied.
+            self.checkpoint(Checkpoint(*self.receiver.last))
+
+    def connect(self):
+        """
+        Sets up the ShellAccounts kept between syncs, with the FAS data
+        they fetched.
+        """
+        if self.sa is None or self.reconnect:
+            self.reconnect = False
+            config = self.config
+            self.sa = ShellAccounts(prefix='/',
+                                    tempdir=config.get('global', 'temp').strip('"'),
+                                    base_url=config.get('global', 'url').strip('"'),
+                                    token_api=config.get('global', 'tokenapi').strip('"'),
+                                    policy=self.policy,
+                                    config=config
+                                    )
+            self.sync = AccountSync(self.sa, config)
+
+    def reconcile(self):
+        """
+        Fetches every user and group from FAS again and checks every account
+        of the host, as install-account does.
+        """
+        self.connect()
+        self.sa.invalidate(users=True, groups=True)
+        self.sync.run(full=True)
+
+    def update_account(self, usernames=(), groupnames=(), passwords=False):
+        """
+        Updates FAS account on your local system
+
+        The FAS data fetched by previous updates is kept, only the given
+        users and groups are fetched again. When only users changed, their
+        accounts are updated one by one unless one of them gained or lost
+        access to this host. Every user is fetched again when passwords
+        changed.
+        """
+        self.connect()
+
+        if passwords:
+            self.sa.invalidate(users=True)
+            usernames = ()
+        elif not groupnames and all(self.sync.update_user(username)
+                                    for username in usernames):
+            return
+
+        with metrics.phase('fetch'):
+            self.sa.refresh(usernames, groupnames,
+                            workers=get_option(self.config, 'daemon',
+                                               'fetch_workers', 4, kind='int'))
+
+        self.sync.run(skippable=False)
+
+    def sync_events(self, events):
+        """ Runs one sync covering all the given events. """
+        usernames = set()
+        groupnames = set()
+        for event in events:
+            usernames.update(event.usernames)
+            groupnames.update(event.groupnames)
+        topics = set(event.topic for event in events)
+        if RECONCILE in topics:
+            # Covers the updates that came along.
+            self.reconcile()
         else:
-            modefile.close()
+            self.update_account(usernames=usernames, groupnames=groupnames,
+                                passwords=REFRESH_USERS in topics)
+        count = sum(event.count for event in events)
+        self.log.info('Sync done, absorbed %i events' % count)
+        metrics.incr('fas_client_events_total', count, result='applied')
+        metrics.incr('fas_client_events_total', count - 1,
+                     result='coalesced')
+        self.sync.export_metrics()
 
-        sa.create_ssh_keys(users)
+        sent = [event for event in events if event.sent]
+        if sent and not self.replaying:
+            last = max(sent, key=lambda event: event.sent)
+            self.checkpoint(Checkpoint(last.msg_id, last.sent))
+        self.log.debug('Daemon metrics: %s' % self.metrics())
+
+    def metrics(self):
+        """ Returns the receiver and scheduler metrics. """
+        metrics = self.receiver.metrics()
+        metrics.update(self.scheduler.metrics())
+        return metrics
+
+    def collect_metrics(self):
+        """ Returns the daemon metrics in the form exported. """
+        daemon = self.metrics()
+        return {
+            ('fas_client_messages_total', (('result', 'received'),)):
+                daemon['received'],
+            ('fas_client_messages_total', (('result', 'accepted'),)):
+                daemon['accepted'],
+            ('fas_client_queue_depth', ()): daemon['depth'],
+            ('fas_client_queue_lag_seconds', ()): daemon['lag'],
+            ('fas_client_message_lag_seconds', ()): daemon['message_lag'],
+        }
 
     def take_action(self, args):
         for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
             signal.signal(sig, self.sig_handler)
 
-        import re
         configs = fedmsg.config.load_config([], None)
 
         configs['mute'] = True
         configs['timeout'] = 0
 
-        group_update = 'group.member.sponsor'
-        user_update = 'user.update'
-        user_data = ['ssh_key', 'password']
-
-        for name, endpoint, topic, sig in fedmsg.tail_messages(**configs):
-            fas_group_topic = re.compile(group_update)
-            fas_user_topic = re.compile('fas.user.update')
-
-            if fas_group_topic.search(topic):
-                self.log.debug('Receiving group update notification.')
-                if sig['msg']['group'] in config.get('host', 'groups').strip('"').split(','):
-                    self.log.debug('Received an update from installed groups')
-                    self.update_account()
-
-            if fas_user_topic.search(topic):
-                self.log.debug('Receiving user update notification.')
-                for i in sig['msg']['fields']:
-                    if i in user_data:
-                        self.log.debug('Received an update from installed account')
-                        self.update_account()
+        self.config = read_config(self.app_args.configfile)
+        # Only FAS messages are sent to us, instead of the whole bus.
+        topic = get_option(self.config, 'daemon', 'topic', '%s.%s.fas.' % (
+            configs['topic_prefix'], configs['environment']))
+
+        self.scheduler = CoalescingScheduler(self.sync_events)
+        self.receiver = MessageReceiver(
+            fedmsg.tail_messages(topic=topic, **configs),
+            None, self.scheduler)
+        self.configure()
+
+        metrics.add_collector(self.collect_metrics)
+        port = get_option(self.config, 'daemon', 'metrics_port', 0, kind='int')
+        if port:
+            try:
+                metrics.serve(port)
+            except socket.error, e:
+                self.log.error('Unable to serve metrics on port %i: %s'
+                               % (port, e))
+
+        self.scheduler.start()
+        self.receiver.start()
+        self.catch_up()
+
+        # Signals are only handled by the main thread, while it is not
+        # blocked in an endless join().
+        while self.receiver.is_alive() and not self.stopping:
+            self.receiver.join(1)
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+        self.shutdown()
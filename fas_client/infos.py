@@ -26,6 +26,7 @@ from cliff.show import ShowOne
 from munch import Munch
 
 from fas_client.shellaccount import ShellAccounts
+from fas_client.records import memory_report
 from fas_client.systemutils import read_config, check_authconfig_value
 from fedora.client.fas2 import AccountStatus, GroupStatus
 
@@ -44,6 +45,13 @@ class Info(ShowOne):
         parser = super(type(self), self).get_parser(prog_name)
         parser.add_argument("--username", dest="username", help="FAS login")
         parser.add_argument("--groupname", dest="groupname", help="FAS group name")
+        parser.add_argument(
+            "--memory-report",
+            dest="memory",
+            action="store_true",
+            default=False,
+            help="Show the memory used by FAS users and groups data",
+        )
 
         return parser
 
@@ -51,7 +59,8 @@ class Info(ShowOne):
         config = read_config(self.app_args.configfile)
 
         fas = ShellAccounts(base_url=self.app_args.fas_server,
-                            token_api=config.get('global', 'tokenapi'))
+                            token_api=config.get('global', 'tokenapi'),
+                            config=config)
 
         if args.username and args.groupname:
             self.log.info(
@@ -108,4 +117,10 @@ class Info(ShowOne):
             else:
                 data['info'] = 'This group has not been setup for this host.'
 
+        if args.memory:
+            report = memory_report(fas.users, fas.groups)
+            for name, (count, size) in sorted(report.iteritems()):
+                data['%s in memory' % name] = '{} records, {:.1f} MiB'.format(
+                    count, size / 1048576.0)
+
         return data.keys(), data.values()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import sys
+import mmap
+
+# Index of the authorized SSH keys of every account of the host, answering
+# sshd's AuthorizedKeysCommand. It holds one "username<TAB>key" line per key,
+# sorted by username, so that a lookup is a binary search over the memory
+# mapped file. Only the standard library is used, to start fast on every SSH
+# login.
+INDEX = '/var/lib/fas/client_authorized_keys'
+
+
+def write_index(filename, entries):
+    """
+    Atomically replaces the index with the (username, keys) entries, keys
+    being the content of the user's authorized_keys. Unicode is written
+    UTF-8 encoded.
+    """
+    lines = []
+    for username, keys in entries:
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        if isinstance(keys, unicode):
+            keys = keys.encode('utf-8')
+        lines.extend('%s\t%s\n' % (username, key)
+                     for key in keys.splitlines() if key)
+    # Sorting is stable, keys keep their order.
+    lines.sort(key=lambda line: line.split('\t', 1)[0])
+
+    # Only imported by the syncs, lookups stick to the standard library.
+    from .systemutils import atomic_write
+
+    # Public keys, read by sshd's AuthorizedKeysCommandUser.
+    atomic_write(filename, lambda index: index.writelines(lines), 0644)
+    return len(lines)
+
+
+def lookup(filename, username):
+    """ Returns the authorized key lines of username. """
+    with open(filename, 'rb') as index:
+        try:
+            data = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty index
+            return []
+    try:
+        # Finds the first line whose username is not lower, lo and hi
+        # always being line starts.
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind('\n', 0, mid) + 1
+            end = data.find('\n', start)
+            if end < 0:
+                end = len(data)
+            if data[start:end].split('\t', 1)[0] < username:
+                lo = end + 1
+            else:
+                hi = start
+
+        keys = []
+        prefix = username + '\t'
+        while lo < len(data) and data[lo:lo + len(prefix)] == prefix:
+            end = data.find('\n', lo)
+            if end < 0:
+                end = len(data)
+            keys.append(data[lo + len(prefix):end])
+            lo = end + 1
+        return keys
+    finally:
+        data.close()
+
+
+def main(argv=None):
+    """
+    Prints the authorized keys of a user, as sshd's AuthorizedKeysCommand:
+
+        fas_client_authorized_keys [INDEX] USERNAME
+    """
+    args = (argv if argv is not None else sys.argv)[1:]
+    if len(args) not in (1, 2):
+        sys.stderr.write('usage: fas_client_authorized_keys [INDEX] '
+                         'USERNAME\n')
+        return 2
+    filename = args[0] if len(args) == 2 else INDEX
+    try:
+        keys = lookup(filename, args[-1])
+    except (IOError, OSError), e:
+        sys.stderr.write('Unable to read %s: %s\n' % (filename, e))
+        return 1
+    for key in keys:
+        sys.stdout.write(key + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import os
+import sys
+import errno
+import pickle
+import ConfigParser
+
+from .keyindex import lookup
+from .systemutils import get_option
+
+# Registry of the homedirs created on first login, when [users] lazy_home is
+# set. Written by the syncs in the key index format, with one
+# "username<TAB>uid<TAB>homedir" line per account of the host.
+HOME_REGISTRY = '/var/lib/fas/client_homes'
+
+
+def _saved_mode(modefile, username):
+    """ Returns the mode username's homedir had when it was locked. """
+    try:
+        with open(modefile, 'r') as modes:
+            return pickle.load(modes).get(username)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def provision(home_dir, uid, skel='/etc/skel', mode=None):
+    """
+    Creates home_dir from skel, or unlocks it when it was locked after its
+    owner lost access. Returns whether anything was done.
+    """
+    # Imported here, only logins that do create a homedir pay for it.
+    from .skel import SkelTemplate, restorecon
+
+    try:
+        dir_stat = os.stat(home_dir)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        if dir_stat.st_uid != 0:
+            return False
+        os.chmod(home_dir, mode if mode is not None else 0755)
+        os.chown(home_dir, uid, uid)
+        return True
+
+    home_dir_base = os.path.dirname(home_dir)
+    if not os.path.exists(home_dir_base):
+        os.makedirs(home_dir_base, mode=0755)
+        restorecon([home_dir_base])
+    try:
+        SkelTemplate.load(skel).create(home_dir, uid, uid)
+    except OSError, e:
+        # Entries are only created in a homedir made here, so it was made
+        # by a concurrent login of the same user.
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    if mode is not None:
+        os.chmod(home_dir, mode)
+    restorecon([home_dir])
+    return True
+
+
+def main(argv=None):
+    """
+    Creates the homedir of the user logging in, as a pam_exec session
+    module:
+
+        session optional pam_exec.so /usr/bin/fas_client_pam_home \\
+            [--config /etc/fas.conf]
+
+    Only the users recorded in the home registry get one.
+    """
+    args = (argv if argv is not None else sys.argv)[1:]
+    configfile = '/etc/fas.conf'
+    if args[:1] == ['--config'] and len(args) == 2:
+        configfile = args[1]
+    elif args:
+        sys.stderr.write('usage: fas_client_pam_home [--config FILE]\n')
+        return 2
+
+    username = os.environ.get('PAM_USER')
+    if not username or os.environ.get('PAM_TYPE') != 'open_session':
+        return 0
+
+    config = ConfigParser.RawConfigParser()
+    config.read(configfile)
+    registry = get_option(config, 'global', 'home_registry', HOME_REGISTRY)
+    try:
+        entries = lookup(registry, username)
+    except (IOError, OSError), e:
+        sys.stderr.write('Unable to read %s: %s\n' % (registry, e))
+        return 1
+    if not entries:
+        # Not an account of this host.
+        return 0
+
+    uid, home_dir = entries[0].split('\t', 1)
+    try:
+        provision(home_dir, int(uid),
+                  skel=get_option(config, 'users', 'skel', '/etc/skel'),
+                  mode=_saved_mode(get_option(
+                      config, 'global', 'modefile',
+                      '/var/lib/fas/client_dir_perms'), username))
+    except (IOError, OSError), e:
+        sys.stderr.write('Unable to create the homedir of %s: %s\n'
+                         % (username, e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import os
+import time
+import errno
+import fcntl
+import logging
+
+
+class SyncLock(object):
+    """
+    Host-wide lock serializing the syncs of install-account and the daemon.
+
+    The lockfile records when the last complete sync started. A caller that
+    had to wait for the lock skips its own sync when a complete sync started
+    after it arrived, since that sync covered what it came for. However many
+    callers pile up behind a running sync, a single follow-up sync runs.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def last_start(self):
+        """
+        Returns when the last complete sync started, None when unknown.
+        """
+        try:
+            fd = os.open(self.filename, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            return self._last_start(fd) or None
+        finally:
+            os.close(fd)
+
+    def _last_start(self, fd):
+        """ Returns when the last complete sync started. """
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            return float(os.read(fd, 64).strip() or 0)
+        except ValueError:
+            return 0
+
+    def _record_start(self, fd, started):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, '%f\n' % started)
+
+    def run(self, sync, complete=True, skippable=True):
+        """
+        Runs sync() under the lock and returns its result.
+
+        ``complete`` tells that sync() covers every account of the host.
+        When ``skippable`` is set and a complete sync started while waiting
+        for the lock, sync() is not run and None is returned.
+        """
+        arrived = time.time()
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                self.log.info('Waiting for the running sync to finish')
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if skippable and self._last_start(fd) > arrived:
+                    self.log.info('Skipping sync, the one that just finished '
+                                  'covered it')
+                    return None
+
+            started = time.time()
+            result = sync()
+            if complete:
+                self._record_start(fd, started)
+            return result
+        finally:
+            # Closing the lockfile releases the lock.
+            os.close(fd)
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+from itertools import chain
+
+from .records import ROLE_TYPES
+
+
+class MembershipIndex(object):
+    """
+    Set based index of FAS group memberships.
+
+    Built once per snapshot of FAS data, it resolves group names as well as
+    ``@type`` and ``@all`` selectors to the set of member uids without
+    scanning the group dump again.
+    """
+
+    def __init__(self, groups, users, cla_group):
+        self.group_members = {}
+        self.user_groups = {}
+        self.type_members = {}
+
+        for name, group in groups.iteritems():
+            uids = frozenset(chain(*[group[role] for role in ROLE_TYPES]))
+            self.group_members[name] = uids
+            for uid in uids:
+                self.user_groups.setdefault(uid, set()).add(name)
+            if not name.startswith('cla_'):
+                self.type_members.setdefault(group['type'], set()).update(uids)
+
+        # Users are good when they are active, have signed a CLA, and are
+        # in at least one other group.
+        self.good_users = frozenset()
+        if cla_group in self.group_members:
+            in_groups = set().union(*self.type_members.itervalues())
+            self.good_users = frozenset(
+                uid for uid in self.group_members[cla_group] & in_groups
+                if uid in users)
+
+    def resolve(self, name):
+        """
+        Returns the uids of the members of a group, of all groups of a type
+        (``@type``) or of the good users (``@all``), or None when there is
+        no such group or group type.
+        """
+        if name.startswith('@'):
+            group_type = name[1:]
+            if group_type == 'all':
+                return self.good_users
+            return self.type_members.get(group_type)
+        return self.group_members.get(name)
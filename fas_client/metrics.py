@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import time
+import logging
+import threading
+import BaseHTTPServer
+
+from contextlib import contextmanager
+
+from .systemutils import atomic_write
+
+# Name, type and help of every metric exported.
+METRICS = {
+    'fas_client_phase_seconds': (
+        'gauge', 'Duration of the last run of each sync phase.'),
+    'fas_client_phase_seconds_total': (
+        'counter', 'Time spent in each sync phase.'),
+    'fas_client_records': (
+        'gauge', 'Users, groups and accounts handled by the last sync.'),
+    'fas_client_nss_bytes': (
+        'gauge', 'Size of the NSS sources written by the last sync.'),
+    'fas_client_syncs_total': (
+        'counter', 'Syncs run, by result.'),
+    'fas_client_last_success_timestamp_seconds': (
+        'gauge', 'When the last successful sync finished.'),
+    'fas_client_messages_total': (
+        'counter', 'Messages received from the bus, and those accepted.'),
+    'fas_client_events_total': (
+        'counter', 'FAS updates applied by a sync, and those coalesced '
+                   'into another one.'),
+    'fas_client_queue_depth': (
+        'gauge', 'FAS updates waiting for a sync.'),
+    'fas_client_queue_lag_seconds': (
+        'gauge', 'Age of the oldest FAS update waiting for a sync.'),
+    'fas_client_message_lag_seconds': (
+        'gauge', 'Delay between the sending and the receiving of the last '
+                 'message.'),
+}
+
+
+class Metrics(object):
+    """
+    Durations and counters of the syncs run by this process, rendered in
+    the Prometheus text format.
+
+    Values are keyed by metric name and label pairs. Collectors are called
+    at rendering time and return more such values, for figures kept
+    elsewhere.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._values = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name, tuple(sorted(labels.items()))] = value
+
+    def incr(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    @contextmanager
+    def phase(self, name, **labels):
+        """ Times the sync phase run in the with block. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self.set('fas_client_phase_seconds', duration, phase=name,
+                     **labels)
+            self.incr('fas_client_phase_seconds_total', duration, phase=name,
+                      **labels)
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format. """
+        with self._lock:
+            values = dict(self._values)
+        for collector in self._collectors:
+            try:
+                values.update(collector())
+            except Exception:
+                self.log.exception('Unable to collect metrics')
+
+        lines = []
+        for name in sorted(set(name for name, labels in values)):
+            kind, doc = METRICS[name]
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name or value is None:
+                    continue
+                if labels:
+                    name_labels = '%s{%s}' % (name, ','.join(
+                        '%s="%s"' % label for label in labels))
+                else:
+                    name_labels = name
+                lines.append('%s %r' % (name_labels, float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        """
+        Atomically writes the metrics for node_exporter's textfile
+        collector, which must never read a partial file.
+        """
+        try:
+            atomic_write(filename,
+                         lambda textfile: textfile.write(self.render()), 0644)
+        except (IOError, OSError), e:
+            self.log.warning('Unable to write metrics to %s: %s'
+                             % (filename, e))
+
+    def serve(self, port, address='127.0.0.1'):
+        """ Serves the metrics over HTTP from a background thread. """
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics.log.debug(format % args)
+
+        server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='fas-client-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+# Shared by everything running a sync in this process.
+metrics = Metrics()
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import os
+import struct
+import hashlib
+import logging
+
+from kitchen.text.converters import to_bytes
+from path import path
+
+# Size of the write buffer kept for each generated file.
+BUFSIZE = 1024 * 1024
+
+# On-disk layout of the databases read by glibc's libnss_db, see
+# nss/nss_db/nss_db.h. Everything is stored in host byte order.
+NSS_DB_MAGIC = 0xdd110601
+NSS_DB_HEADER = struct.Struct('=IIQQQ')
+NSS_DB_INDEX = struct.Struct('=c3xIQQQ')
+STRIDX_EMPTY = 0xffffffff
+
+log = logging.getLogger(__name__)
+
+
+def hash_string(key):
+    """ Returns the glibc __hash_string() value of key. """
+    hval = 0
+    for char in bytearray(key):
+        hval = ((hval << 4) + char) & 0xffffffffffffffff
+        g = hval & 0xf0000000
+        if g:
+            hval ^= g >> 24
+            hval ^= g
+    return hval & 0xffffffff
+
+
+def next_prime(seed):
+    """ Returns the smallest odd prime greater or equal to seed. """
+    seed = max(seed, 3) | 1
+    while any(seed % div == 0 for div in xrange(3, int(seed ** 0.5) + 1, 2)):
+        seed += 2
+    return seed
+
+
+def _probe(hashval, hashsize):
+    """ Yields the slots visited by libnss_db when looking up hashval. """
+    hidx = hashval % hashsize
+    hval2 = 1 + hashval % (hashsize - 2)
+    while True:
+        yield hidx
+        hidx += hval2
+        if hidx >= hashsize:
+            hidx -= hashsize
+
+
+def read_source(filename):
+    """ Yields (key, value) pairs from a makedb(1) source file. """
+    with open(filename, 'rb') as source:
+        for line in source:
+            line = line.lstrip().rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                yield parts[0], parts[1]
+
+
+class NssDbBuilder(object):
+    """
+    In-process replacement for makedb(1).
+
+    Entries are stored the way libnss_db reads them: a table of NUL
+    terminated values, shared between keys, and one double-hashed table per
+    key type (the first character of the key: ``=``, ``0``, ``.``).
+    """
+
+    def __init__(self):
+        self._values = []
+        self._value_idx = {}
+        self._valstrlen = 0
+        self._databases = {}
+
+    def add(self, key, value):
+        """ Adds value under key, whose first character is the key type. """
+        dbid, key = key[0], key[1:]
+        entries = self._databases.setdefault(dbid, {})
+        if key in entries:
+            log.warning('Duplicate key %s%s, ignoring' % (dbid, key))
+            return
+        idx = self._value_idx.get(value)
+        if idx is None:
+            idx = self._value_idx[value] = self._valstrlen
+            self._values.append(value)
+            self._valstrlen += len(value) + 1
+        entries[key] = idx
+
+    def write(self, filename, mode=None):
+        """ Writes the database to filename. """
+        valstrtab = '\0'.join(self._values) + '\0' if self._values else ''
+        # Hash tables are arrays of uint32_t, keep them aligned.
+        valstrtab += '\0' * (-len(valstrtab) % 4)
+
+        dbids = sorted(self._databases)
+        offset = NSS_DB_HEADER.size + len(dbids) * NSS_DB_INDEX.size
+        valstroff = offset
+        offset += len(valstrtab)
+
+        tables = []
+        for dbid in dbids:
+            entries = self._databases[dbid]
+            hashsize = next_prime(2 * len(entries))
+            hashtable = [STRIDX_EMPTY] * hashsize
+            keyidxtab = [STRIDX_EMPTY] * hashsize
+            keystrtab = []
+            keystrlen = 0
+            hashed = sorted((hash_string(key), key, validx)
+                            for key, validx in entries.iteritems())
+            for hashval, key, validx in hashed:
+                for hidx in _probe(hashval, hashsize):
+                    if hashtable[hidx] == STRIDX_EMPTY:
+                        break
+                hashtable[hidx] = validx
+                keyidxtab[hidx] = keystrlen
+                keystrtab.append(key + '\0')
+                keystrlen += len(key) + 1
+            tables.append((dbid, hashsize, hashtable, keyidxtab,
+                           ''.join(keystrtab)))
+
+        index = []
+        hashdata = []
+        for dbid, hashsize, hashtable, _, _ in tables:
+            hashdata.append(struct.pack('=%iI' % hashsize, *hashtable))
+            index.append([dbid, hashsize, offset])
+            offset += hashsize * 4
+        keydata = []
+        for entry, (_, hashsize, _, keyidxtab, keystrtab) in zip(index,
+                                                                 tables):
+            keydata.append(struct.pack('=%iI' % hashsize, *keyidxtab))
+            entry.append(offset)
+            offset += hashsize * 4
+        for entry, (_, _, _, _, keystrtab) in zip(index, tables):
+            keydata.append(keystrtab)
+            entry.append(offset)
+            offset += len(keystrtab)
+
+        with open(filename, 'wb') as output:
+            if mode is not None:
+                os.fchmod(output.fileno(), mode)
+            output.write(NSS_DB_HEADER.pack(NSS_DB_MAGIC, len(index),
+                                            valstroff, len(valstrtab),
+                                            offset))
+            for entry in index:
+                output.write(NSS_DB_INDEX.pack(*entry))
+            output.write(valstrtab)
+            output.write(''.join(hashdata))
+            output.write(''.join(keydata))
+
+
+class NssDb(object):
+    """ Read-only access to a database written by makedb or NssDbBuilder. """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as db:
+            self._data = db.read()
+        (magic, ndbs, self._valstroff, self._valstrlen,
+         _) = NSS_DB_HEADER.unpack_from(self._data)
+        if magic != NSS_DB_MAGIC:
+            raise ValueError('%s is not a NSS database' % filename)
+        self._databases = {}
+        for i in xrange(ndbs):
+            entry = NSS_DB_INDEX.unpack_from(
+                self._data, NSS_DB_HEADER.size + i * NSS_DB_INDEX.size)
+            self._databases[entry[0]] = entry[1:]
+
+    def _string(self, offset):
+        return self._data[offset:self._data.index('\0', offset)]
+
+    def lookup(self, key):
+        """ Returns the value stored under key or None. """
+        dbid, key = key[0], key[1:]
+        if dbid not in self._databases:
+            return None
+        hashsize, hashoffset, keyidxoffset, keystroffset = \
+            self._databases[dbid]
+        for hidx in _probe(hash_string(key), hashsize):
+            validx, = struct.unpack_from('=I', self._data,
+                                         hashoffset + hidx * 4)
+            if validx == STRIDX_EMPTY:
+                return None
+            keyidx, = struct.unpack_from('=I', self._data,
+                                         keyidxoffset + hidx * 4)
+            if self._string(keystroffset + keyidx) == key:
+                return self._string(self._valstroff + validx)
+
+
+def verify_db(source, *databases):
+    """
+    Checks that every key of a makedb(1) source file resolves to the same
+    value in all given databases. Returns the list of mismatching keys.
+    """
+    databases = [NssDb(db) for db in databases]
+    mismatches = []
+    for key, value in read_source(source):
+        if any(db.lookup(key) != value for db in databases):
+            mismatches.append(key)
+    return mismatches
+
+
+class NssRecordWriter(object):
+    """
+    Buffered writer for makedb(1) source files.
+
+    Every entry is written under the three keys libnss_db looks up:
+    ``=id``, ``0index`` and ``.name``. The file is opened once and kept open
+    until close() so that generating a full FAS dump costs a handful of
+    write(2) calls instead of several per account. When a NssDbBuilder is
+    given, entries are also fed to it so the database can be written without
+    parsing the file back.
+    """
+
+    def __init__(self, filename, mode=None, bufsize=BUFSIZE, builder=None):
+        self.filename = path(filename)
+        self.builder = builder
+        self.records = 0
+        self.bytes = 0
+        self._sha256 = hashlib.sha256()
+        self._file = open(self.filename, 'wb', bufsize)
+        if mode is not None:
+            os.fchmod(self._file.fileno(), mode)
+
+    def add(self, ident, name, entry):
+        """ Writes entry keyed by its id, its index and its name. """
+        name = to_bytes(name)
+        entry = to_bytes(entry)
+        data = '=%s %s\n0%i %s\n.%s %s\n' % (ident, entry,
+                                             self.records, entry,
+                                             name, entry)
+        self._file.write(data)
+        self._sha256.update(data)
+        if self.builder is not None:
+            self.builder.add('=%s' % ident, entry)
+            self.builder.add('0%i' % self.records, entry)
+            self.builder.add('.%s' % name, entry)
+        self.records += 1
+        self.bytes += len(data)
+
+    @property
+    def digest(self):
+        """ SHA-256 of everything written so far. """
+        return self._sha256.hexdigest()
+
+    def close(self):
+        """ Flushes and closes the underlying file. """
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
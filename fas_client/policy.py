@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+from collections import namedtuple
+
+from path import path
+
+from .systemutils import get_option
+
+# What an account looks like on this host. Every user given the same kind of
+# account shares the same instance.
+AccountPolicy = namedtuple('AccountPolicy', 'shell ssh_cmd ssh_options')
+
+
+def _get_list(config, section, option):
+    """ Returns a comma separated config value as a tuple. """
+    values = get_option(config, section, option).split(',')
+    return tuple(filter(None, [value.strip() for value in values]))
+
+
+class HostPolicy(namedtuple('HostPolicy', 'groups restricted_groups cla_group '
+                                          'home home_base full restricted')):
+    """
+    Host settings resolved once from fas.conf.
+
+    ``full`` and ``restricted`` are the AccountPolicy given to members of
+    ``groups`` and ``restricted_groups`` respectively. ``home`` is the
+    configured homedir location and ``home_base`` that location under the
+    install prefix.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config, prefix='/'):
+        """ Resolves the policy of the host described by config. """
+        home = get_option(config, 'users', 'home')
+        return cls(
+            groups=_get_list(config, 'host', 'groups'),
+            restricted_groups=_get_list(config, 'host', 'restricted_groups'),
+            cla_group=get_option(config, 'global', 'cla_group'),
+            home=home,
+            home_base=path(prefix + home.lstrip('/')),
+            full=AccountPolicy(
+                shell=get_option(config, 'users', 'ssh_restricted_shell'),
+                ssh_cmd=get_option(config, 'users', 'ssh_admin_app', ''),
+                ssh_options=get_option(config, 'users', 'ssh_admin_options',
+                                       '')),
+            restricted=AccountPolicy(
+                shell=get_option(config, 'users', 'shell'),
+                ssh_cmd=get_option(config, 'users', 'ssh_restricted_app'),
+                ssh_options=get_option(config, 'users', 'ssh_key_options')),
+        )
+
+    def home_dir(self, username):
+        """ Returns the homedir of username. """
+        return self.home_base.joinpath(username)
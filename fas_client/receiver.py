@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import time
+import logging
+import threading
+
+
+class MessageReceiver(threading.Thread):
+    """
+    Reads the message bus and hands FAS events over to a scheduler.
+
+    Messages are read on their own thread, so the bus keeps being drained
+    while a sync runs. ``classify`` turns a message into a SyncEvent, or
+    None when the host does not care about it.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, messages, classify, scheduler):
+        threading.Thread.__init__(self, name='fas-client-receive')
+        self.daemon = True
+        self.messages = messages
+        self.classify = classify
+        self.scheduler = scheduler
+        self.received = 0
+        self.accepted = 0
+        self.lag = 0.0
+        self.last = None
+        self.dropped = False
+        self.stopped = False
+
+    def stop(self):
+        """ Stops handing messages over. """
+        self.stopped = True
+
+    def metrics(self):
+        """
+        Returns the message counters and the delay between the sending and
+        the receiving of the last message (``message_lag``).
+        """
+        return {
+            'received': self.received,
+            'accepted': self.accepted,
+            'message_lag': self.lag,
+        }
+
+    def handle(self, topic, msg, live=True):
+        """
+        Hands the event msg calls for over to the scheduler. Returns
+        whether there was one and the scheduler took it.
+
+        ``last`` only moves past messages that were queued or that call
+        for nothing. It stays before the first one dropped while stopping,
+        so the next start replays it.
+        """
+        self.received += 1
+        if live and msg.get('timestamp'):
+            self.lag = max(0.0, time.time() - msg['timestamp'])
+        try:
+            event = self.classify(topic, msg)
+        except Exception:
+            self.log.exception('Unable to handle message on %s' % topic)
+            event = None
+        if event is not None:
+            if not self.scheduler.submit(event):
+                self.log.debug('Dropped message on %s, stopping' % topic)
+                self.dropped = True
+                return False
+            self.accepted += 1
+        if live and not self.dropped:
+            self.last = (msg.get('msg_id'), msg.get('timestamp'))
+        return event is not None
+
+    def run(self):
+        for name, endpoint, topic, msg in self.messages:
+            if self.stopped:
+                break
+            self.handle(topic, msg)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import sys
+
+from array import array
+
+from kitchen.text.converters import to_bytes
+
+ROLE_TYPES = ('administrators', 'sponsors', 'users')
+
+# Shadow password field of users without a password hash.
+LOCKED_PASSWORD = '!'
+
+
+class Record(object):
+    """
+    Slotted record, readable like the JSON dicts it replaces
+    (``user['username']``) so callers do not have to care.
+    """
+
+    __slots__ = ()
+    _interned = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getstate__(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, ' '.join(
+            '%s=%r' % (slot, getattr(self, slot)) for slot in self.__slots__))
+
+
+class UserRecord(Record):
+    """ The fields of a FAS user the client makes use of. """
+
+    __slots__ = ('id', 'username', 'human_name', 'password', 'ssh_key',
+                 'email', 'alias_enabled')
+    _interned = ('username',)
+
+    def __init__(self, id, username, human_name, password, ssh_key, email,
+                 alias_enabled):
+        self.id = id
+        self.username = username
+        self.human_name = human_name
+        self.password = password
+        self.ssh_key = ssh_key
+        self.email = email
+        self.alias_enabled = alias_enabled
+
+    @classmethod
+    def from_fas(cls, uid, user):
+        """ Builds a record from FAS' user_data() entry of uid. """
+        # Text is kept UTF-8 encoded, which takes a quarter of the memory
+        # of unicode objects on UCS-4 builds. A missing hash locks the
+        # password, an empty one would let anyone in.
+        return cls(int(uid), intern(to_bytes(user['username'])),
+                   to_bytes(user.get('human_name') or ''),
+                   to_bytes(user.get('password') or LOCKED_PASSWORD),
+                   to_bytes(user['ssh_key']) if user.get('ssh_key') else None,
+                   to_bytes(user.get('email') or ''),
+                   bool(user.get('alias_enabled')))
+
+    @classmethod
+    def from_person(cls, person):
+        """ Builds a record from FAS' person_by_username() result. """
+        return cls.from_fas(person['id'], person)
+
+
+class GroupRecord(Record):
+    """ The fields of a FAS group the client makes use of. """
+
+    __slots__ = ('id', 'type', 'administrators', 'sponsors', 'users')
+    _interned = ('type',)
+
+    def __init__(self, id, type, administrators, sponsors, users):
+        self.id = id
+        self.type = type
+        self.administrators = administrators
+        self.sponsors = sponsors
+        self.users = users
+
+    @classmethod
+    def from_fas(cls, group):
+        """ Builds a record from a FAS' group_data() entry. """
+        return cls(int(group['id']), intern(to_bytes(group['type'])),
+                   array('i', group['administrators']),
+                   array('i', group['sponsors']),
+                   array('i', group['users']))
+
+    @classmethod
+    def from_group(cls, group):
+        """ Builds a record from FAS' group_by_name() result. """
+        roles = dict((role, array('i')) for role in ROLE_TYPES)
+        for role in group['approved_roles']:
+            roles[role['role_type'] + 's'].append(role['person_id'])
+        return cls(int(group['id']), intern(to_bytes(group['group_type'])),
+                   roles['administrators'], roles['sponsors'], roles['users'])
+
+
+def load_users(user_data):
+    """ Returns FAS' user_data() as records keyed by integer uid. """
+    return dict((int(uid), UserRecord.from_fas(uid, user))
+                for uid, user in user_data.iteritems())
+
+
+def load_groups(group_data):
+    """ Returns FAS' group_data() as records keyed by group name. """
+    return dict((intern(to_bytes(name)), GroupRecord.from_fas(group))
+                for name, group in group_data.iteritems())
+
+
+def _sizeof(obj):
+    """ Returns the memory used by obj and the values it holds. """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, Record):
+        for slot in obj.__slots__:
+            # Interned strings are shared between records, don't count them.
+            if slot not in obj._interned:
+                size += sys.getsizeof(getattr(obj, slot))
+    return size
+
+
+def memory_report(users, groups):
+    """ Returns the approximate memory held by user and group records. """
+    report = {}
+    for name, records in (('users', users), ('groups', groups)):
+        size = sys.getsizeof(records)
+        for key, record in records.iteritems():
+            size += sys.getsizeof(key) + _sizeof(record)
+        report[name] = (len(records), size)
+    return report
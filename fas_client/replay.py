@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import json
+import time
+import urllib
+import urllib2
+import logging
+
+from collections import namedtuple
+
+from .systemutils import atomic_write
+
+# The last message the daemon applied.
+Checkpoint = namedtuple('Checkpoint', 'msg_id timestamp')
+
+
+class ReplayGap(Exception):
+    """ Raised when the missed messages are too old or too many to replay. """
+
+
+def load_checkpoint(filename):
+    """ Returns the checkpoint saved in filename, or None. """
+    try:
+        with open(filename, 'rb') as statefile:
+            state = json.load(statefile)
+        return Checkpoint(state['msg_id'], float(state['timestamp']))
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_checkpoint(filename, checkpoint):
+    """ Atomically replaces the checkpoint saved in filename. """
+    atomic_write(filename,
+                 lambda statefile: json.dump(checkpoint._asdict(), statefile))
+
+
+class MessageHistory(object):
+    """
+    History of the message bus, served by datagrepper or any endpoint
+    answering its ``/raw`` queries.
+
+    Messages more than ``max_age`` seconds old, or more than
+    ``max_messages`` of them, are not worth replaying: a full sync is
+    cheaper. ReplayGap is raised instead.
+    """
+
+    log = logging.getLogger(__name__)
+
+    rows_per_page = 100
+
+    def __init__(self, url, category='fas', max_age=86400,
+                 max_messages=10000, timeout=30):
+        self.url = url.rstrip('/') + '/raw'
+        self.category = category
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.timeout = timeout
+
+    def _page(self, start, end, page):
+        query = urllib.urlencode({
+            'category': self.category,
+            'start': start,
+            'end': end,
+            'order': 'asc',
+            'rows_per_page': self.rows_per_page,
+            'page': page,
+        })
+        try:
+            response = urllib2.urlopen('%s?%s' % (self.url, query),
+                                       timeout=self.timeout)
+            try:
+                return json.load(response)
+            finally:
+                response.close()
+        except (urllib2.URLError, IOError, ValueError), e:
+            raise ReplayGap('unable to query %s: %s' % (self.url, e))
+
+    def messages(self, checkpoint, end=None):
+        """
+        Yields the topic and content of the messages sent after checkpoint,
+        oldest first.
+        """
+        end = end or time.time()
+        if end - checkpoint.timestamp > self.max_age:
+            raise ReplayGap('last message applied %is ago'
+                            % (end - checkpoint.timestamp))
+
+        page = self._page(checkpoint.timestamp, end, 1)
+        if page.get('total', 0) > self.max_messages:
+            raise ReplayGap('%i messages missed' % page['total'])
+        self.log.info('Replaying %i messages sent since %s'
+                      % (page.get('total', 0), time.ctime(checkpoint.timestamp)))
+
+        number = 1
+        while True:
+            for msg in page.get('raw_messages', []):
+                # The start of the query is inclusive.
+                if msg.get('topic') and \
+                        msg.get('msg_id') != checkpoint.msg_id:
+                    yield msg['topic'], msg
+            if number >= page.get('pages', 1):
+                break
+            number += 1
+            page = self._page(checkpoint.timestamp, end, number)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import re
+
+from .scheduler import REFRESH_USERS, make_event
+
+# Matches the FAS part of a fedmsg topic, whatever its prefix and environment.
+FAS_TOPIC = re.compile(r'\.fas\.([a-z.]+)$')
+
+
+def group_selector(policy):
+    """
+    Returns the names of the groups whose changes matter to the host, or
+    None when any group may matter (``@type`` selectors).
+    """
+    names = policy.groups + policy.restricted_groups
+    if any(name.startswith('@') for name in names):
+        return None
+    # Signing the CLA is what makes a group member a good user.
+    return frozenset(names + (policy.cla_group,))
+
+
+class GroupMembership(object):
+    """ A user was added to or removed from a group. """
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __call__(self, topic, body):
+        group = body['group']
+        if self.groups is None or group in self.groups:
+            return make_event(topic, usernames=[body['user']],
+                              groupnames=[group])
+
+
+class GroupLifecycle(object):
+    """ A group was created, changed or deleted. """
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __call__(self, topic, body):
+        group = body['group']
+        if self.groups is None or group in self.groups:
+            return make_event(topic, groupnames=[group])
+
+
+class UserUpdate(object):
+    """ One of the fields of a user the host keeps was changed. """
+
+    fields = frozenset(('ssh_key', 'password'))
+
+    def __call__(self, topic, body):
+        fields = self.fields.intersection(body['fields'])
+        if 'password' in fields:
+            # The new hash is only given by FAS' user_data().
+            return make_event(REFRESH_USERS, usernames=[body['user']])
+        elif fields:
+            return make_event(topic, usernames=[body['user']])
+
+
+class UserStatus(UserUpdate):
+    """ A user was activated, deactivated or blocked. """
+
+    fields = frozenset(('status',))
+
+
+class Router(object):
+    """
+    Routes FAS messages to the handler of their topic.
+
+    ``routes`` maps the FAS part of a topic (``group.member.sponsor``) to
+    the handlers of its messages. Messages of other topics are dropped
+    without looking at their content.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+
+    @classmethod
+    def for_policy(cls, policy):
+        """ Returns the router of a host configured with policy. """
+        groups = group_selector(policy)
+        membership = (GroupMembership(groups),)
+        lifecycle = (GroupLifecycle(groups),)
+        return cls({
+            'group.member.sponsor': membership,
+            'group.member.remove': membership,
+            'group.create': lifecycle,
+            'group.update': lifecycle,
+            'group.delete': lifecycle,
+            'user.update': (UserUpdate(), UserStatus()),
+        })
+
+    def route(self, topic, msg):
+        """ Returns the SyncEvent a message calls for, if any. """
+        match = FAS_TOPIC.search(topic)
+        if match is None:
+            return None
+        handlers = self.routes.get(match.group(1), ())
+        for handler in handlers:
+            event = handler(topic, msg['msg'])
+            if event is not None:
+                return event._replace(msg_id=msg.get('msg_id'),
+                                      sent=msg.get('timestamp'))
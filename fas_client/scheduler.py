@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import time
+import random
+import logging
+import threading
+
+from collections import namedtuple
+
+# An update announced by FAS: the users and groups it is about, the id and
+# sending time of the message that announced it, if any, and how many
+# events it stands for once folded.
+SyncEvent = namedtuple('SyncEvent',
+                       'topic usernames groupnames received msg_id sent count')
+
+# Topic of the events asking for a full reconciliation with FAS.
+RECONCILE = 'reconcile'
+
+# Topic of the events asking for every user to be fetched again, only FAS'
+# user_data() gives their password hashes.
+REFRESH_USERS = 'refresh-users'
+
+
+def make_event(topic, usernames=(), groupnames=(), msg_id=None, sent=None):
+    """ Returns a SyncEvent received now. """
+    return SyncEvent(topic, frozenset(usernames), frozenset(groupnames),
+                     time.time(), msg_id, sent, 1)
+
+
+def fold_events(events):
+    """ Returns a single SyncEvent covering all the given events. """
+    topics = set(e.topic for e in events)
+    topic = 'folded'
+    for special in (RECONCILE, REFRESH_USERS):
+        if special in topics:
+            topic = special
+            break
+    return SyncEvent(topic,
+                     frozenset().union(*[e.usernames for e in events]),
+                     frozenset().union(*[e.groupnames for e in events]),
+                     events[0].received, events[-1].msg_id, events[-1].sent,
+                     sum(e.count for e in events))
+
+
+class CoalescingScheduler(object):
+    """
+    Merges bursts of events into a single sync.
+
+    A sync starts once no event was submitted for ``quiet`` seconds, or
+    ``max_delay`` seconds after the first pending event, whichever comes
+    first. The callback runs in a worker thread and receives every event
+    the sync absorbed.
+
+    At most ``maxsize`` events are kept pending. Past that, they are folded
+    into a single event, so nothing is lost however long a sync takes.
+
+    Once reconcile_every() is called, a RECONCILE event is also added to
+    the sync due at each reconciliation time.
+
+    The events of a failed sync are queued again and retried ``max_delay``
+    seconds later, along with the ones submitted meanwhile.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, callback, quiet=5, max_delay=60, maxsize=1000):
+        self.callback = callback
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.maxsize = maxsize
+        self.submitted = 0
+        self.folds = 0
+        self.syncs = 0
+        self.failures = 0
+        self.last_duration = None
+        self.interval = None
+        self.jitter = 0
+        self.max_staleness = None
+        self.reconciled = None
+        self._next_reconcile = None
+        self._busy_since = None
+        self._retry_at = None
+        self._stopping = False
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='fas-client-sync')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def configure(self, quiet, max_delay, maxsize):
+        """ Changes the timings and queue size of the syncs to come. """
+        with self._cond:
+            self.quiet = quiet
+            self.max_delay = max_delay
+            self.maxsize = maxsize
+            self._cond.notify()
+
+    def submit(self, event):
+        """
+        Queues event for the next sync. Returns False when the scheduler
+        is stopping and the event was dropped.
+        """
+        with self._cond:
+            if self._stopping:
+                return False
+            self.submitted += 1
+            if len(self._pending) >= self.maxsize:
+                self.folds += 1
+                self._pending = [fold_events(self._pending)]
+            self._pending.append(event)
+            self._cond.notify()
+        return True
+
+    def stop(self, timeout):
+        """
+        Stops accepting events, runs the pending ones right away and waits
+        up to timeout seconds for the syncs to finish. Returns whether they
+        did. Events whose sync failed are not retried anymore.
+        """
+        end = time.time() + timeout
+        with self._cond:
+            self._stopping = True
+            self._next_reconcile = None
+            self._cond.notify_all()
+            while (self._pending and self._retry_at is None) or \
+                    self._busy_since:
+                if time.time() >= end:
+                    return False
+                self._cond.wait(end - time.time())
+            return not self._pending
+
+    def reconcile_every(self, interval, jitter=0, max_staleness=None,
+                        last=None):
+        """
+        Plans a full reconciliation every ``interval`` seconds, give or take
+        ``jitter`` seconds so that hosts do not all reconcile at once. Past
+        ``max_staleness`` seconds without a successful one, a failed
+        reconciliation is retried every ``max_delay`` seconds.
+
+        The first reconciliation happens one interval after ``last``, the
+        time of the last known one, or within ``jitter`` seconds. No
+        interval stops planning them.
+        """
+        now = time.time()
+        with self._cond:
+            self.interval = interval
+            if not interval:
+                self._next_reconcile = None
+                self._cond.notify()
+                return
+            self.jitter = jitter
+            self.max_staleness = max_staleness or interval + jitter
+            self.reconciled = last or now
+            self._next_reconcile = now + random.uniform(0, jitter)
+            if last:
+                self._next_reconcile = max(self._next_reconcile, min(
+                    last + interval + random.uniform(-jitter, jitter),
+                    last + self.max_staleness))
+            self._cond.notify()
+
+    def _plan_reconcile(self, now):
+        delay = max(0, self.interval + random.uniform(-self.jitter,
+                                                      self.jitter))
+        self._next_reconcile = max(
+            min(now + delay, self.reconciled + self.max_staleness),
+            now + self.max_delay)
+
+    def metrics(self):
+        """
+        Returns the number of pending events, the age of the oldest one
+        (``lag``), how long the running sync has been going on (``busy``)
+        and the event and sync counters.
+        """
+        now = time.time()
+        with self._cond:
+            return {
+                'depth': len(self._pending),
+                'lag': now - self._pending[0].received if self._pending else 0.0,
+                'busy': now - self._busy_since if self._busy_since else 0.0,
+                'submitted': self.submitted,
+                'folds': self.folds,
+                'syncs': self.syncs,
+                'failures': self.failures,
+                'last_duration': self.last_duration,
+                'last_reconcile': self.reconciled,
+                'next_reconcile': self._next_reconcile,
+            }
+
+    def _deadline(self):
+        """ Returns when the next sync is due, None if none is planned. """
+        if self._pending and self._stopping:
+            return time.time() if self._retry_at is None else None
+        deadlines = []
+        if self._pending:
+            deadline = min(self._pending[-1].received + self.quiet,
+                           self._pending[0].received + self.max_delay)
+            if self._retry_at is not None:
+                deadline = max(deadline, self._retry_at)
+            deadlines.append(deadline)
+        if self._next_reconcile is not None:
+            deadlines.append(self._next_reconcile)
+        return min(deadlines) if deadlines else None
+
+    def _wait(self):
+        """
+        Blocks until a sync is due and returns the events it absorbs, or
+        None once stopped.
+        """
+        with self._cond:
+            while True:
+                deadline = self._deadline()
+                if deadline is None and self._stopping:
+                    return None
+                elif deadline is None:
+                    self._cond.wait()
+                elif deadline > time.time():
+                    self._cond.wait(deadline - time.time())
+                else:
+                    break
+            events, self._pending = self._pending, []
+            now = time.time()
+            if self._next_reconcile is not None and \
+                    self._next_reconcile <= now:
+                events.append(SyncEvent(RECONCILE, frozenset(), frozenset(),
+                                        self._next_reconcile, None, None, 1))
+                # Planned again once this one is done.
+                self._next_reconcile = None
+            self._busy_since = now
+        return events
+
+    def _run(self):
+        while True:
+            events = self._wait()
+            if events is None:
+                break
+            self.log.info('Starting sync for %i events, oldest received %.1fs '
+                          'ago' % (sum(event.count for event in events),
+                                   time.time() - events[0].received))
+            success = False
+            try:
+                self.callback(events)
+                success = True
+            except Exception:
+                self.failures += 1
+                self.log.exception('Sync failed')
+            with self._cond:
+                now = time.time()
+                self.syncs += 1
+                self.last_duration = now - self._busy_since
+                if success:
+                    self._retry_at = None
+                else:
+                    # Reconciliations are planned again below.
+                    retry = [event for event in events
+                             if event.topic != RECONCILE]
+                    if retry:
+                        self._pending[:0] = [fold_events(retry)]
+                        self._retry_at = now + self.max_delay
+                if any(event.topic == RECONCILE for event in events):
+                    if success:
+                        self.reconciled = self._busy_since
+                    if self.interval and not self._stopping:
+                        self._plan_reconcile(now)
+                self._busy_since = None
+                self._cond.notify_all()
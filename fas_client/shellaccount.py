@@ -22,34 +22,120 @@
 # Current Author(s): Xavier Lamien <laxathom@fedoraproject.org>
 
 import logging
-import ConfigParser
 
 from kitchen.text.converters import to_bytes
+from fedora.client import AppError
 from fedora.client.fas2 import AccountSystem
 
-from .systemutils import read_config, chown, drop_privs
+from .systemutils import (read_config, drop_privs, atomic_write,
+                          save_pickle, get_option)
+from .cache import DataCache
+from .membership import MembershipIndex
+from .records import load_users, load_groups, UserRecord, GroupRecord
+from .policy import HostPolicy
+from .nssdb import NssRecordWriter, NssDbBuilder, verify_db, BUFSIZE
+from .metrics import metrics
+from .skel import SkelTemplate
 
 import os
+import sys
 import pwd
 import codecs
+import time
+import pickle
+import hashlib
 import tempfile
 
+from multiprocessing.pool import ThreadPool
+
 try:
     import selinux
     from shutil import rmtree
-    from selinux import copytree, install as move
+    from selinux import install as move
 
     have_selinux = (selinux.is_selinux_enabled() == 1)
 except ImportError:
-    from shutil import move, rmtree, copytree
+    from shutil import move, rmtree
 
     have_selinux = False
 
+from shutil import copyfileobj
 from path import path
 from sh import makedb
 
 config = read_config()
 
+# Backends available to compile NSS databases. 'verify' builds with both
+# and keeps makedb's output whenever a lookup differs.
+NSS_BACKENDS = ('makedb', 'builtin', 'verify')
+
+
+# Used by forked workers, never taking any lock the parent may have held.
+_worker_log = logging.getLogger(__name__ + '.worker')
+_worker_log.addHandler(logging.NullHandler())
+_worker_log.propagate = False
+
+
+def _ssh_key_entry(key_file, digest):
+    """ Returns the manifest entry of an authorized_keys file. """
+    st = os.lstat(key_file)
+    return (digest, st.st_mtime, st.st_ctime, st.st_ino, st.st_size)
+
+
+def install_ssh_keys(home_dir, keys, known=None):
+    """
+    Writes keys to the authorized_keys of home_dir, or removes that file
+    when keys is None. Meant to run with the privileges of its owner.
+
+    Returns the manifest entry of the file written, or None. Nothing is
+    written when known, the entry recorded by the last write, still matches
+    both keys and the file: any change to the file changes its ctime.
+    """
+    ssh_dir = home_dir.joinpath('.ssh')
+    key_file = ssh_dir.joinpath('authorized_keys')
+
+    if keys is not None:
+        digest = hashlib.sha256(keys).hexdigest()
+        if known is not None and known[0] == digest:
+            try:
+                if _ssh_key_entry(key_file, digest) == known:
+                    return known
+            except OSError:
+                pass
+        if not os.path.exists(ssh_dir):
+            os.makedirs(ssh_dir, mode=0700)
+        key_file.open('a+').close()
+        if key_file.bytes() != keys:
+            key_file.write_bytes(keys)
+        os.chmod(key_file, 0600)
+        if have_selinux:
+            selinux.restorecon(ssh_dir, recursive=True)
+        return _ssh_key_entry(key_file, digest)
+    else:
+        # If the user does not have an SSH key listed, ensure
+        # that their authorized_key file does not exist.
+        try:
+            os.remove(key_file)
+        except OSError:
+            pass
+        return None
+
+
+def _fetch_all(fetches, workers):
+    """
+    Returns the results of the (fetch, argument) calls, running up to
+    workers of them at a time. FAS requests mostly wait on the network, so
+    threads are enough to overlap them.
+    """
+    if len(fetches) < 2 or workers < 2:
+        return [fetch(arg) for fetch, arg in fetches]
+    pool = ThreadPool(min(workers, len(fetches)))
+    try:
+        pending = [pool.apply_async(fetch, (arg,)) for fetch, arg in fetches]
+        return [result.get() for result in pending]
+    finally:
+        pool.terminate()
+
 
 class ShellAccounts(AccountSystem):
     log = logging.getLogger(__name__)
@@ -59,12 +145,23 @@ class ShellAccounts(AccountSystem):
     _orig_groups = None
     _users = None
     _groups = None
-    _good_users = None
-    _group_types = None
+    _membership = None
     _temp = None
     _tempdir = None
     _prefix = None
     _dbdir = None
+    _nss_backend = None
+    _digestfile = None
+    _db_digests = None
+    _cache = None
+    _ttl = None
+    _skel = None
+    _home_workers = 1
+    _ssh_workers = 1
+    _ssh_manifest = None
+    _loaded = None
+    _invalid = None
+    policy = None
 
     def __init__(self, prefix="/", tempdir="/tmp", *args, **kwargs):
         self._orig_euid = os.geteuid()
@@ -73,8 +170,40 @@ class ShellAccounts(AccountSystem):
         self._prefix = prefix
         self._tempdir = path(prefix).joinpath(tempdir)
         self._dbdir = '/var/db/'
-        home_dir_base = path(self._prefix).joinpath(
-            config.get('users', 'home').strip('"').lstrip('/'))
+
+        conf = kwargs.pop('config', config)
+        policy = kwargs.pop('policy', None)
+        if policy is None:
+            policy = HostPolicy.from_config(conf, prefix)
+        self.policy = policy
+
+        self._nss_backend = get_option(conf, 'global', 'nss_backend', 'makedb')
+        if self._nss_backend not in NSS_BACKENDS:
+            self.log.error('Unknown NSS backend %s, using makedb'
+                           % self._nss_backend)
+            self._nss_backend = 'makedb'
+
+        self._digestfile = get_option(conf, 'global', 'digestfile',
+                                      '/var/lib/fas/client_db_digests')
+        self._cache = DataCache(self._tempdir, get_option(
+            conf, 'global', 'cache_ttl', 0, kind='int'))
+
+        # How long users and groups are kept in memory, 0 keeps them until
+        # they are invalidated.
+        self._ttl = {}
+        for dataset in ('users', 'groups'):
+            self._ttl[dataset] = get_option(conf, 'global', dataset + '_ttl',
+                                            0, kind='int')
+        self._loaded = {}
+        self._invalid = set()
+
+        self._skel = get_option(conf, 'users', 'skel', '/etc/skel')
+        self._home_workers = get_option(conf, 'global', 'home_workers', 1,
+                                        kind='int')
+        self._ssh_workers = get_option(conf, 'global', 'ssh_workers', 1,
+                                       kind='int')
+        self._ssh_manifest = get_option(conf, 'global', 'ssh_manifest',
+                                        '/var/lib/fas/client_ssh_manifest')
 
         force_refresh = kwargs.get('force_refresh')
         if force_refresh is None:
@@ -84,9 +213,11 @@ class ShellAccounts(AccountSystem):
             self.force_refresh = force_refresh
         super(ShellAccounts, self).__init__(*args, **kwargs)
 
-    @property
     def _make_tempdir(self, force=False):
-        """ Returns a temporary directory. """
+        """
+        Returns a temporary directory, replacing the previous one when
+        force is set.
+        """
         if not self._temp or force:
             # Remove any existing temp directories
             if self._temp:
@@ -96,123 +227,220 @@ class ShellAccounts(AccountSystem):
             self._temp = tempfile.mkdtemp('-tmp', 'fas-', self._tempdir)
         return path(self._temp)
 
-    @property
-    def _refresh_users(self, force=False):
-        """ Returns a list of users in FAS. """
-        # Cached values present, return
-        if not self._users or force:
-            self._users = self.user_data()
+    def _expired(self, dataset):
+        """ Tells whether an in-memory dataset has to be fetched again. """
+        if dataset in self._invalid:
+            return True
+        ttl = self._ttl.get(dataset)
+        return bool(ttl) and time.time() - self._loaded[dataset] > ttl
+
+    def refresh_users(self, force=False):
+        """
+        Returns the users in FAS, fetching them when they were never loaded,
+        are older than their TTL, were invalidated, or force is set.
+        """
+        if self._users is None or force or self._expired('users'):
+            force = force or self.force_refresh or 'users' in self._invalid
+            self._users = load_users(self._cache.get(
+                'users', self.user_data, force=force))
+            self._loaded['users'] = time.time()
+            self._invalid.discard('users')
+            self._membership = None
         return self._users
 
-    @property
-    def _refresh_groups(self, force=False):
-        """ Returns a list of groups in FAS. """
-        # Cached values present, return
-        if not self._groups or force:
-            group_data = self.group_data(force_refresh=self.force_refresh)
-            # The JSON output from FAS encodes dictionary keys as strings,
-            # but leaves
-            # array elements as integers (in the case of group member UIDs).  This
-            # normalizes them to all strings.
-            for group in group_data:
-                for role_type in ('administrators', 'sponsors', 'users'):
-                    group_data[group][role_type] = [str(uid) for uid in
-                                                    group_data[group][role_type]]
-            self._groups = group_data
+    def refresh_groups(self, force=False):
+        """
+        Returns the groups in FAS, fetching them when they were never loaded,
+        are older than their TTL, were invalidated, or force is set.
+        """
+        if self._groups is None or force or self._expired('groups'):
+            force = force or self.force_refresh or 'groups' in self._invalid
+            self._groups = load_groups(self._cache.get(
+                'groups',
+                lambda: self.group_data(force_refresh=force),
+                force=force))
+            self._loaded['groups'] = time.time()
+            self._invalid.discard('groups')
+            self._membership = None
         return self._groups
 
-    def _refresh_good_users_group_types(self, force=False):
+    def _loaded_users(self):
+        """
+        Returns the users in FAS as last refreshed, fetching them the first
+        time only: their TTL is checked by refresh_all(), once per sync.
+        """
+        if self._users is None:
+            return self.refresh_users()
+        return self._users
+
+    def _loaded_groups(self):
+        """
+        Returns the groups in FAS as last refreshed, fetching them the first
+        time only: their TTL is checked by refresh_all(), once per sync.
+        """
+        if self._groups is None:
+            return self.refresh_groups()
+        return self._groups
+
+    def invalidate(self, users=False, groups=False):
+        """
+        Marks datasets as outdated. They are fetched again from FAS,
+        bypassing the on-disk cache, the next time they are used.
+        """
+        if users:
+            self._invalid.add('users')
+        if groups:
+            self._invalid.add('groups')
+
+    def refresh_user(self, username):
+        """
+        Fetches a single user from FAS and updates the loaded users.
+        Returns the user's record, or None when the account is not active.
+        """
+        return self._apply_person(username, self._fetch_person(username))
+
+    def refresh_group(self, groupname):
+        """
+        Fetches a single group from FAS and updates the loaded groups.
+        Returns the group's record, or None when it no longer exists.
+        """
+        return self._apply_group(groupname, self._fetch_group(groupname))
+
+    def refresh(self, usernames=(), groupnames=(), workers=4):
+        """
+        Fetches the given users and groups from FAS, at most workers at a
+        time, and updates the loaded ones.
+        """
+        fetches = [(self._fetch_group, name) for name in groupnames] + \
+                  [(self._fetch_person, name) for name in usernames]
+        results = _fetch_all(fetches, workers)
+        for (fetch, name), result in zip(fetches, results):
+            if fetch == self._fetch_group:
+                self._apply_group(name, result)
+            else:
+                self._apply_person(name, result)
+
+    def refresh_all(self):
+        """
+        Makes sure users and groups are loaded, fetching both at the same
+        time when both are due. Meant to be called at the start of a sync,
+        which then uses the same data throughout.
+        """
+        _fetch_all([(self.refresh_users, False),
+                    (self.refresh_groups, False)], 2)
+
+    def _fetch_person(self, username):
+        """
+        Returns the FAS account of username, or None when FAS has none.
+        Other failures are raised, they must not remove the user.
+        """
+        # Unknown users are answered with an empty result.
+        return self.person_by_username(username) or None
+
+    def _fetch_group(self, groupname):
+        """
+        Returns the FAS group groupname, or None when FAS has none. Other
+        failures are raised, they must not remove the group.
+        """
+        try:
+            return self.group_by_name(groupname)
+        except AppError, e:
+            # What group_by_name() raises when FAS could not find the group,
+            # server side errors come with the name of their exception.
+            if e.name != 'FASError':
+                raise
+            self.log.debug('Unable to fetch %s: %s' % (groupname, e))
+            return None
+
+    def _apply_person(self, username, person):
+        users = self.users
+        record = None
+        if person and person.get('status') == 'active':
+            record = UserRecord.from_person(person)
+            if record.id not in users:
+                # Newly active users may now be good users.
+                self._membership = None
+            if not person.get('password'):
+                # person_by_username() may not give the password hash, the
+                # one of user_data() is kept, or fetched with it.
+                if record.id in users:
+                    record.password = users[record.id].password
+                else:
+                    self.invalidate(users=True)
+            users[record.id] = record
+        else:
+            for uid, user in users.items():
+                if user.username == username:
+                    del users[uid]
+                    self._membership = None
+        return record
+
+    def _apply_group(self, groupname, group):
+        groups = self.groups
+        record = None
+        if group:
+            record = GroupRecord.from_group(group)
+            groups[intern(to_bytes(groupname))] = record
+        else:
+            groups.pop(groupname, None)
+        self._membership = None
+        return record
+
+    def _refresh_membership(self, force=False):
+        """ Returns the membership index of the current FAS data. """
+        users = self.users
+        groups = self.groups
         # Cached values present, return
-        if self._good_users and self._group_types and not force:
-            return
+        if self._membership is not None and not force:
+            return self._membership
 
-        cla_group = config.get('global', 'cla_group').strip('"')
-        if cla_group not in self.groups:
+        cla_group = self.policy.cla_group
+        if cla_group not in groups:
             self.log.info('No such group: %s\n Aborting!' % cla_group)
             sys.exit(1)
 
-        cla_uids = self.groups[cla_group]['users'] + \
-                   self.groups[cla_group]['sponsors'] + \
-                   self.groups[cla_group]['administrators']
-
-        user_groupcount = {}
-        group_types = {}
-        for uid in cla_uids:
-            user_groupcount[uid] = 0
+        self._membership = MembershipIndex(groups, users, cla_group)
+        return self._membership
 
-        for group in self.groups:
-            group_type = self.groups[group]['type']
-            if group.startswith('cla_'):
-                continue
-            for uid in self.groups[group]['users'] + \
-                    self.groups[group]['sponsors'] + \
-                    self.groups[group]['administrators']:
-                if group_type not in group_types:
-                    group_types[group_type] = set()
-                group_types[group_type].add(uid)
-                if uid in user_groupcount:
-                    user_groupcount[uid] += 1
-
-        good_users = set()
-        for uid in user_groupcount:
-            # If the user is active, has signed a CLA, and is in at least one
-            # other group, add them to good_users.
-            if uid in self.users and user_groupcount[uid] > 0:
-                good_users.add(uid)
-
-        self._good_users = good_users
-        self._group_types = group_types
-
-    @property
     def _refresh_good_users(self, force=False):
         """ Return a list of users in who have CLA + 1 group. """
-        self._refresh_good_users_group_types(force)
-        return self._good_users
+        return self._refresh_membership(force).good_users
 
-    @property
     def _refresh_group_types(self, force=False):
         """ Return a list of users in group with various types. """
-        self._refresh_good_users_group_types(force)
-        return self._group_types
+        return self._refresh_membership(force).type_members
 
     def filter_users(self, valid_groups=None, restricted_groups=None):
         """
         Return a list of users who get normal and restricted accounts on a
         machine.
+
+        Groups default to the ones of the host policy. Each user is mapped
+        to the shared AccountPolicy of the most privileged group they are in.
         """
 
-        if valid_groups is None:
-            valid_groups = []
-        if restricted_groups is None:
-            restricted_groups = []
+        if valid_groups is None and restricted_groups is None:
+            valid_groups = self.policy.groups
+            restricted_groups = self.policy.restricted_groups
+        valid_groups = list(valid_groups or [])
+        restricted_groups = list(restricted_groups or [])
 
         all_groups = valid_groups + restricted_groups
         all_groups = filter(None, all_groups)
 
         users = {}
 
+        membership = self._refresh_membership()
         for group in all_groups:
-            uids = set()
             restricted = group not in valid_groups
 
-            if group.startswith('@'):
-                # Filter by group type
-                group_type = group[1:]
-                if group_type == 'all':
-                    # It's all good as long as a the user is in CLA + one group
-                    uids.update(self.good_users)
+            uids = membership.resolve(group)
+            if uids is None:
+                if group.startswith('@'):
+                    self.log.error('No such group type: %s' % group[1:])
                 else:
-                    if group_type not in self.group_types:
-                        self.log.error('No such group type: %s' % group_type)
-                        continue
-                    uids.update(self.group_types[group_type])
-            else:
-                if group not in self.groups:
                     self.log.warn('No such group: %s' % group)
-                    continue
-                uids.update(self.groups[group]['users'])
-                uids.update(self.groups[group]['sponsors'])
-                uids.update(self.groups[group]['administrators'])
+                continue
 
             for uid in uids:
                 if uid not in self.users:
@@ -221,84 +449,94 @@ class ShellAccounts(AccountSystem):
                 if restricted:
                     # Make sure that the most privileged group wins.
                     if uid not in users:
-                        users[uid] = {}
-                        users[uid]['shell'] = config.get(
-                            'users', 'shell').strip('"')
-                        users[uid]['ssh_cmd'] = config.get(
-                            'users', 'ssh_restricted_app').strip('"')
-                        users[uid]['ssh_options'] = config.get(
-                            'users', 'ssh_key_options').strip('"')
+                        users[uid] = self.policy.restricted
                 else:
-                    users[uid] = {}
-                    users[uid]['shell'] = config.get(
-                        'users', 'ssh_restricted_shell').strip('"')
-                    try:
-                        users[uid]['ssh_cmd'] = config.get(
-                            'users', 'ssh_admin_app').strip('"')
-                    except ConfigParser.NoOptionError:
-                        users[uid]['ssh_cmd'] = ''
-                    try:
-                        users[uid]['ssh_options'] = config.get(
-                            'users', 'ssh_admin_options').strip('"')
-                    except ConfigParser.NoOptionError:
-                        users[uid]['ssh_options'] = ''
+                    users[uid] = self.policy.full
         return users
 
-    def create_passwd_text(self, users, passwdfile, shadowfile):
-        """ Creates the NSS password file. """
+    def create_nss_text(self, users, passwdfile=None, shadowfile=None,
+                        groupfile=None):
+        """
+        Creates the NSS passwd, shadow and group files in a single pass over
+        the given users and FAS groups.
 
-        home_dir_base = path(
-            self._prefix + config.get('users', 'home').strip('"').lstrip('/'))
+        Any of the files may be omitted. Returns the list of writers used so
+        that callers can report how many records and bytes were written.
+        """
+        home_dir_base = to_bytes(self.policy.home_base)
 
-        shadowfile.open(mode='w')
-        shadowfile.chmod(00600)
+        def writer(filename, mode=None):
+            if filename is None:
+                return None
+            builder = None
+            if self._nss_backend != 'makedb':
+                builder = NssDbBuilder()
+            return NssRecordWriter(filename, mode=mode, builder=builder)
 
-        passwdfile.open(mode='w')
+        passwd = writer(passwdfile)
+        shadow = writer(shadowfile, mode=00600)
+        group = writer(groupfile)
+        records = self.users
 
-        i = 0
         for uid, user in sorted(users.iteritems()):
             # Struct user account's metadata
-            username = self.users[uid]['username']
-            human_name = self.users[uid]['human_name']
-            password = self.users[uid]['password']
-            home_dir = '%s/%s' % (home_dir_base, username)
-            shell = user['shell']
-
-            passwdfile.write_text('=%s %s:x:%s:%s:%s:%s:%s\n'
-                                  % (uid, username, uid, uid, human_name,
-                                     home_dir, shell), append=True)
-            passwdfile.write_text('0%i %s:x:%s:%s:%s:%s:%s\n'
-                                  % (i, username, uid, uid, human_name,
-                                     home_dir, shell), append=True)
-            passwdfile.write_text('.%s %s:x:%s:%s:%s:%s:%s\n'
-                                  % (username, username, uid, uid,
-                                     human_name, home_dir, shell), append=True)
-
-            shadowfile.write_text('=%s %s:%s::::7:::\n'
-                                  % (uid, username, password), append=True)
-            shadowfile.write_text('0%i %s:%s::::7:::\n'
-                                  % (i, username, password), append=True)
-            shadowfile.write_text('.%s %s:%s::::7:::\n'
-                                  % (username, username, password), append=True)
-            i += 1
+            username = records[uid]['username']
+
+            if passwd is not None:
+                passwd.add(uid, username, '%s:x:%s:%s:%s:%s/%s:%s' % (
+                    username, uid, uid, records[uid]['human_name'],
+                    home_dir_base, username, user.shell))
+            if shadow is not None:
+                shadow.add(uid, username, '%s:%s::::7:::' % (
+                    username, records[uid]['password']))
+            # Only create user groups for users that actually exist on
+            # the system
+            if group is not None:
+                group.add(uid, username, '%s:x:%s:' % (username, uid))
+
+        if group is not None:
+            for groupname, fas_group in sorted(self.groups.iteritems()):
+                gid = fas_group['id']
+                members = []
+
+                for member_uid in self.membership.group_members[groupname]:
+                    try:
+                        members.append(records[member_uid]['username'])
+                    except KeyError:
+                        # This means that the user is most likely disabled :/
+                        pass
+
+                members.sort()
+                group.add(gid, groupname, '%s:x:%i:%s' % (
+                    groupname, gid, ','.join(members)))
+
+        writers = [w for w in (passwd, shadow, group) if w is not None]
+        for writer in writers:
+            writer.close()
+            self.log.debug('Wrote %i records (%i bytes) to %s' % (
+                writer.records, writer.bytes, writer.filename))
+        return writers
+
+    def create_passwd_text(self, users, passwdfile, shadowfile):
+        """ Creates the NSS password file. """
+        self.create_nss_text(users, passwdfile=passwdfile,
+                             shadowfile=shadowfile)
 
     def create_home_dirs(self, users, modes=None):
         """ Creates homedirs and home base dir if they do not exist. """
         if modes is None:
             modes = {}
-        home_dir_base = to_bytes(path(
-            self._prefix + config.get('users', 'home').strip('"').lstrip('/')))
+        home_dir_base = to_bytes(self.policy.home_base)
         if not os.path.exists(home_dir_base):
             os.makedirs(home_dir_base, mode=0755)
             if have_selinux:
                 selinux.restorecon(home_dir_base)
+        new_homes = []
         for uid in users:
             username = to_bytes(self.users[uid]['username'])
             home_dir = os.path.join(home_dir_base, username)
             if not os.path.exists(home_dir):
-                self.log.info('Creating homedir for %s' % username)
-                copytree('/etc/skel/', home_dir)
-                os.path.walk(home_dir, chown, [int(uid), int(uid)])
+                new_homes.append((home_dir, int(uid), int(uid)))
             else:
                 dir_stat = os.stat(home_dir)
                 if dir_stat.st_uid == 0:
@@ -308,17 +546,35 @@ class ShellAccounts(AccountSystem):
                         os.chmod(home_dir, 0755)
                     os.chown(home_dir, int(uid), int(uid))
 
-    def remove_stale_homedirs(self, users):
-        """ Removes homedirs of users that no longer have access. """
-        home_dir_base = path(
-            self._prefix + config.get('users', 'home').strip('"').lstrip('/'))
-        valid_users = [self.users[uid]['username'] for uid in users]
-        current_users = os.listdir(home_dir_base)
+        if new_homes:
+            # Read once for all the homedirs of this run.
+            SkelTemplate.load(self._skel).create_all(
+                new_homes, workers=self._home_workers)
+
+    def remove_stale_homedirs(self, users, stale=None):
+        """
+        Removes homedirs of users that no longer have access.
+
+        Every homedir is checked unless stale, a list of usernames known to
+        have lost access, is given.
+        """
+        home_dir_base = self.policy.home_base
+        valid_users = set(self.users[uid]['username'] for uid in users)
+        if stale is None:
+            if not os.path.isdir(home_dir_base):
+                # With lazy_home, it is only made at the first login.
+                return {}
+            current_users = os.listdir(home_dir_base)
+        else:
+            current_users = [to_bytes(user) for user in stale]
         modes = {}
         for user in current_users:
             if user not in valid_users:
-                home_dir = path(home_dir_base + user)
-                dir_stat = os.stat(home_dir)
+                home_dir = home_dir_base.joinpath(user)
+                try:
+                    dir_stat = os.stat(home_dir)
+                except OSError:
+                    continue
                 if dir_stat.st_uid != 0:
                     modes[user] = dir_stat.st_mode
                     self.log.info('Locking permissions on %s' % home_dir)
@@ -326,150 +582,344 @@ class ShellAccounts(AccountSystem):
                     home_dir.chown(0, 0)
         return modes
 
-    def create_ssh_key_user(self, uid, users):
-        home_dir_base = path(self._prefix + config.get('users', 'home')
-                             .strip('"').lstrip('/'))
+    def render_ssh_keys(self, uid, account):
+        """
+        Returns the authorized_keys content of uid given their account on
+        this host, or None when they have no SSH key.
+        """
+        ssh_key = self.users[uid]['ssh_key']
+        if not ssh_key:
+            return None
+        if account.ssh_cmd or account.ssh_options:
+            key = []
+            for key_tmp in ssh_key.split("\n"):
+                if key_tmp:
+                    key.append('command="%s",%s %s' % (
+                        account.ssh_cmd, account.ssh_options, key_tmp))
+            ssh_key = "\n".join(key)
+        return to_bytes(ssh_key) + '\n'
 
+    def create_ssh_key_user(self, uid, users):
         username = self.users[uid]['username']
         self.log.debug('Building ssh key for user %s' % username)
+        install_ssh_keys(self.policy.home_dir(username),
+                         self.render_ssh_keys(uid, users[uid]))
 
-        ssh_dir = path(home_dir_base + '/' + username + '/.ssh')
-        key_file = path(ssh_dir + '/authorized_keys')
-
-        if self.users[uid]['ssh_key']:
-            if users[uid]['ssh_cmd'] or users[uid]['ssh_options']:
-                key = []
-                for key_tmp in self.users[uid]['ssh_key'].split("\n"):
-                    if key_tmp:
-                        key.append('command="%s",%s %s' % (
-                            users[uid]['ssh_cmd'], users[uid]['ssh_options'],
-                            key_tmp))
-                key = "\n".join(key)
-            else:
-                key = self.users[uid]['ssh_key']
-            if not os.path.exists(ssh_dir):
-                os.makedirs(ssh_dir, mode=0700)
-            key_file.open('a+')
-            if key_file.text(encoding='utf-8') != key + '\n':
-                # f.truncate(0)
-                key_file.write_text(key + '\n')
-            os.chmod(key_file, 0600)
-            if have_selinux:
-                selinux.restorecon(ssh_dir, recursive=True)
-        else:
-            # If the user does not have an SSH key listed, ensure
-            # that their authorized_key file does not exist.
-            try:
-                os.remove(key_file)
-            except OSError:
-                pass
+    def _passwd_entry(self, uid, username):
+        """ Returns the passwd entry of uid, as written to the NSS db. """
+        return pwd.struct_passwd((username, 'x', uid, uid, '',
+                                  self.policy.home_dir(username), ''))
 
-    def create_ssh_keys(self, users):
-        """ Creates SSH keys from given FAS' account. """
-        home_dir_base = path(
-            self._prefix + config.get('users', 'home').strip('"').lstrip('/'))
-        for uid in users:
-            pw = pwd.getpwuid(int(uid))
-            lock_dir = False
+    def create_ssh_keys(self, users, workers=None):
+        """
+        Creates SSH keys from given FAS' account.
 
-            drop_privs(pw)
+        With more than one worker, keys are written by forked processes that
+        each take a share of the users, so the privileges of this process
+        are never dropped. The homedirs of the users whose keys could not be
+        written are locked.
 
+        A root-only manifest records the files written, so that the ones
+        still matching their keys are not written again. Returns the uids
+        whose keys were not written.
+        """
+        if workers is None:
+            workers = self._ssh_workers
+        manifest = self._load_ssh_manifest()
+        jobs = [(uid, self.users[uid]['username'],
+                 self.render_ssh_keys(uid, users[uid]), manifest.get(uid))
+                for uid in users]
+        if workers > 1 and len(jobs) > 1:
+            failed, entries = self._install_ssh_keys_forked(jobs, workers)
+        else:
+            failed, entries = self._install_ssh_keys(jobs)
+
+        skipped = sum(1 for uid, username, keys, known in jobs
+                      if known is not None and entries.get(uid) == known)
+        self.log.debug('%i of %i authorized_keys were up to date'
+                       % (skipped, len(jobs)))
+        manifest.update(entries)
+        for uid, username in failed:
+            manifest.pop(uid, None)
+        self._save_ssh_manifest(manifest)
+
+        for uid, username in failed:
+            self.log.error('Error when creating SSH key for %s!' % uid)
+            self.log.error('Locking their home directory, please investigate.')
+            home_dir = self.policy.home_dir(username)
             try:
-                self.create_ssh_key_user(uid, users)
-            except IOError, e:
-                self.log.error('Error when creating SSH key for %s!' % uid)
-                self.log.error('Locking their home directory, please investigate.')
-                lock_dir = True
-
-            # Restore priveleges
-            os.seteuid(self._orig_euid)
-            os.setegid(self._orig_egid)
-            os.setgroups(self._orig_groups)
-
-            if lock_dir:
-                os.chmod(pw.pw_dir, 0700)
-                os.chown(pw.pw_dir, 0, 0)
+                os.chmod(home_dir, 0700)
+                os.chown(home_dir, 0, 0)
+            except OSError, e:
+                self.log.error('Unable to lock %s: %s' % (home_dir, e))
+        return set(uid for uid, username, keys, known in jobs
+                   if uid not in entries)
+
+    def remove_ssh_keys(self, users, written=False, workers=None):
+        """
+        Removes the authorized_keys of the given users, whose keys are
+        served from the key index instead, with the privileges of each user.
+        Only the files the manifest records are removed when written is set.
+        The failed ones stay in the manifest, to be removed by the next sync.
+        """
+        if workers is None:
+            workers = self._ssh_workers
+        manifest = self._load_ssh_manifest()
+        if written:
+            users = [uid for uid in users if uid in manifest]
+        if not users:
+            return
+        jobs = [(uid, self.users[uid]['username'], None, None)
+                for uid in users]
+        if workers > 1 and len(jobs) > 1:
+            failed, entries = self._install_ssh_keys_forked(jobs, workers)
+        else:
+            failed, entries = self._install_ssh_keys(jobs)
+
+        for uid in set(users).difference(uid for uid, username in failed):
+            manifest.pop(uid, None)
+        self._save_ssh_manifest(manifest)
+        for uid, username in failed:
+            self.log.error('Unable to remove the authorized_keys of %s'
+                           % username)
+
+    def _load_ssh_manifest(self):
+        """ Returns the authorized_keys written by the last syncs. """
+        try:
+            with open(self._ssh_manifest, 'rb') as manifest:
+                return pickle.load(manifest)
+        except (IOError, EOFError, pickle.UnpicklingError), e:
+            self.log.debug('Unable to read from file: %s' % e)
+            return {}
+
+    def _save_ssh_manifest(self, manifest):
+        """ Saves the authorized_keys manifest, readable by root only. """
+        try:
+            save_pickle(self._ssh_manifest, manifest)
+        except (IOError, OSError), e:
+            self.log.debug('Unable to write to file: %s' % e)
+
+    def _install_ssh_keys(self, jobs):
+        """
+        Writes the keys of the (uid, username, keys, known) jobs with the
+        privileges of each user. Returns the (uid, username) whose keys
+        failed and the manifest entries of the others.
+        """
+        failed = []
+        entries = {}
+        for uid, username, keys, known in jobs:
+            self.log.debug('Building ssh key for user %s' % username)
+            try:
+                drop_privs(self._passwd_entry(uid, username))
+                entries[uid] = install_ssh_keys(self.policy.home_dir(username),
+                                                keys, known)
+            except (IOError, OSError):
+                failed.append((uid, username))
+            finally:
+                # Restore priveleges
+                os.seteuid(self._orig_euid)
+                os.setegid(self._orig_egid)
+                os.setgroups(self._orig_groups)
+        return failed, entries
+
+    def _install_ssh_keys_forked(self, jobs, workers):
+        """
+        Splits the jobs between forked workers. Returns what the workers
+        reported: the (uid, username) whose keys failed and the manifest
+        entries of the others.
+        """
+        children = {}
+        for batch in [jobs[i::workers] for i in range(workers)]:
+            if not batch:
+                continue
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                status = 1
+                try:
+                    # Other threads of the parent may have held logging
+                    # locks when it forked.
+                    self.log = _worker_log
+                    with os.fdopen(write_fd, 'wb') as report:
+                        pickle.dump(self._install_ssh_keys(batch), report,
+                                    pickle.HIGHEST_PROTOCOL)
+                    status = 0
+                finally:
+                    os._exit(status)
+            os.close(write_fd)
+            children[pid] = os.fdopen(read_fd, 'rb')
+
+        failed = []
+        entries = {}
+        for pid, report in children.iteritems():
+            with report:
+                try:
+                    batch_failed, batch_entries = pickle.load(report)
+                except (EOFError, pickle.UnpicklingError):
+                    batch_failed, batch_entries = [], {}
+            failed.extend(batch_failed)
+            entries.update(batch_entries)
+            status = os.waitpid(pid, 0)[1]
+            if status:
+                self.log.error('SSH keys worker %i exited with status %i, '
+                               'some keys may not be up to date'
+                               % (pid, status))
+        return failed, entries
 
     def make_db(self, input, output=None):
         """ Compile input file to NSS db"""
         makedb(input, output=output)
 
-    def make_group_db(self, users, filename, install=True):
-        """ Compiles the groups file. """
-        input_file = self.temp.joinpath(filename + '.txt')
-        output_file = self.temp.joinpath(filename + '.db')
+    def _load_db_digests(self):
+        """ Returns the digests of the installed NSS databases. """
+        if self._db_digests is None:
+            try:
+                with open(self._digestfile, 'rb') as digestfile:
+                    self._db_digests = pickle.load(digestfile)
+            except (IOError, EOFError, pickle.UnpicklingError), e:
+                self.log.debug('Unable to read from file: %s' % e)
+                self._db_digests = {}
+        return self._db_digests
+
+    def _save_db_digests(self):
+        """ Saves the digests of the installed NSS databases. """
+        if self._db_digests is None:
+            return
+        try:
+            save_pickle(self._digestfile, self._db_digests)
+        except (IOError, OSError), e:
+            self.log.debug('Unable to write to file: %s' % e)
+
+    def _db_unchanged(self, name, digest):
+        """ Tells whether the installed db name was built from digest. """
+        installed = path(self._dbdir).joinpath(name)
+        try:
+            db_stat = installed.stat()
+        except OSError:
+            return False
+        return self._load_db_digests().get(name) == (
+            digest, db_stat.st_size, db_stat.st_mtime)
+
+    def _compile_db(self, writer, install=True, mode=None):
+        """
+        Compiles a generated NSS text file and installs it, unless the
+        installed db was built from the very same content.
+        """
+        output_file = writer.filename.stripext() + '.db'
 
-        self.create_groups_text(users, input_file)
-        self.make_db(input_file, output_file)
+        if install and self._db_unchanged(output_file.name, writer.digest):
+            self.log.info('%s is up to date (sha256 %s), skipping' % (
+                output_file.name, writer.digest))
+            return
 
-        if install:
-            # output_file.move(self._dbdir)
-            output_file.copy2(self._dbdir)
+        with metrics.phase('makedb', db=output_file.namebase):
+            if writer.builder is None:
+                self.make_db(writer.filename, output_file)
+            else:
+                writer.builder.write(output_file)
+                if self._nss_backend == 'verify':
+                    self._verify_db(writer.filename, output_file)
 
-    def make_passwd_db(self, users, passwd, shadow,
-                       install_passwd=True, install_shadow=True):
-        """ Compiles the password and shadow files. """
-        passwd_input = self.temp.joinpath(passwd + '.txt')
-        passwd_output = self.temp.joinpath(passwd + '.db')
-        shadow_input = self.temp.joinpath(shadow + '.txt')
-        shadow_output = self.temp.joinpath(shadow + '.db')
+        if mode is not None:
+            writer.filename.chmod(mode)
+            output_file.chmod(mode)
+
+        if install:
+            with metrics.phase('install', db=output_file.namebase):
+                db_stat = self._install_db(output_file).stat()
+            self._load_db_digests()[output_file.name] = (
+                writer.digest, db_stat.st_size, db_stat.st_mtime)
+            self.log.info('Installed %s (sha256 %s)' % (
+                output_file.name, writer.digest))
+
+    def _install_db(self, output_file):
+        """
+        Atomically replaces the installed db with output_file.
 
-        self.create_passwd_text(users, passwd_input, shadow_input)
+        The file is staged next to the installed one, synced and renamed
+        over it, so lookups see either the old or the new database and never
+        a partially written one. Returns the installed file.
+        """
+        installed = path(self._dbdir).joinpath(output_file.name)
 
-        self.make_db(passwd_input, passwd_output)
-        self.make_db(shadow_input, shadow_output)
+        if output_file.stat().st_dev == path(self._dbdir).stat().st_dev:
+            # Already on the right filesystem, no need to copy anything.
+            fd = os.open(output_file, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(output_file, installed)
+        else:
+            def copy(stage):
+                with open(output_file, 'rb') as source:
+                    copyfileobj(source, stage, BUFSIZE)
+            atomic_write(installed, copy, output_file.stat().st_mode & 07777)
+        dir_fd = os.open(self._dbdir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        if have_selinux:
+            selinux.restorecon(installed)
+        return installed
+
+    def _verify_db(self, input_file, output_file):
+        """ Checks a builtin NSS db against the output of makedb. """
+        reference = output_file + '.makedb'
+        self.make_db(input_file, reference)
+
+        mismatches = verify_db(input_file, output_file, reference)
+        if mismatches:
+            self.log.error('%s differs from makedb output on %i keys (%s), '
+                           'using makedb output' % (
+                               output_file, len(mismatches),
+                               ', '.join(mismatches[:5])))
+            os.rename(reference, output_file)
+        else:
+            self.log.debug('%s lookups match makedb output' % output_file)
+            reference.remove()
+
+    def make_nss_db(self, users, group='group', passwd='passwd',
+                    shadow='shadow', install_group=True, install_passwd=True,
+                    install_shadow=True):
+        """ Compiles the group, password and shadow files. """
+        files = {}
+        installs = {}
+        for kind, filename, install, mode in (
+                ('groupfile', group, install_group, None),
+                ('passwdfile', passwd, install_passwd, None),
+                ('shadowfile', shadow, install_shadow, 0400)):
+            if filename:
+                files[kind] = self.temp.joinpath(filename + '.txt')
+                installs[files[kind]] = (install, mode)
+
+        with metrics.phase('nss_text'):
+            writers = self.create_nss_text(users, **files)
+        for writer in writers:
+            metrics.set('fas_client_nss_bytes', writer.bytes,
+                        db=writer.filename.namebase)
+            install, mode = installs[writer.filename]
+            self._compile_db(writer, install, mode)
+        self._save_db_digests()
 
-        shadow_input.chmod(0400)
-        shadow_output.chmod(0400)
+    def make_group_db(self, users, filename, install=True):
+        """ Compiles the groups file. """
+        self.make_nss_db(users, group=filename, passwd=None, shadow=None,
+                         install_group=install)
 
-        if install_passwd:
-            # passwd_output.move(self._dbdir)
-            passwd_output.copy2(self._dbdir)
-        if install_shadow:
-            # shadow_output.move(self._dbdir)
-            shadow_output.copy2(self._dbdir)
+    def make_passwd_db(self, users, passwd, shadow,
+                       install_passwd=True, install_shadow=True):
+        """ Compiles the password and shadow files. """
+        self.make_nss_db(users, group=None, passwd=passwd, shadow=shadow,
+                         install_passwd=install_passwd,
+                         install_shadow=install_shadow)
 
     def create_groups_text(self, users, groupfile):
         """ Creates the NSS groups file. """
-        groupfile.open('w')
-
-        # First create all of our users/groups combo, then
-        # Only create user groups for users that actually exist on the system
-        i = 0
-        for uid in sorted(users.iterkeys()):
-            username = self.users[uid]['username']
-            groupfile.write_text('=%s %s:x:%s:\n' %
-                                 (uid, username, uid), append=True)
-            groupfile.write_text('0%i %s:x:%s:\n' %
-                                 (i, username, uid), append=True)
-            groupfile.write_text('.%s %s:x:%s:\n' %
-                                 (username, username, uid), append=True)
-            i += 1
-
-        for groupname, group in sorted(self.groups.iteritems()):
-            gid = group['id']
-            members = []
-            memberships = ''
-
-            for member_uid in group['administrators'] + \
-                    group['sponsors'] + \
-                    group['users']:
-                try:
-                    members.append(self.users[member_uid]['username'])
-                except KeyError:
-                    # This means that the user is most likely disabled :/
-                    pass
-
-            members.sort()
-            memberships = ','.join(members)
-            groupfile.write_text('=%i %s:x:%i:%s\n'
-                                 % (gid, groupname, gid, memberships), append=True)
-            groupfile.write_text('0%i %s:x:%i:%s\n'
-                                 % (i, groupname, gid, memberships), append=True)
-            groupfile.write_text('.%s %s:x:%i:%s\n'
-                                 % (groupname, groupname, gid, memberships),
-                                 append=True)
-            i += 1
+        self.create_nss_text(users, groupfile=groupfile)
 
     def get_username_data(self, username):
         """ Returns a bunch() of FAS user's metadata """
@@ -481,8 +931,9 @@ class ShellAccounts(AccountSystem):
         if self.temp:
             rmtree(self.temp)
 
-    temp = _make_tempdir
-    users = _refresh_users
-    groups = _refresh_groups
-    good_users = _refresh_good_users
-    group_types = _refresh_group_types
+    temp = property(_make_tempdir)
+    users = property(_loaded_users)
+    groups = property(_loaded_groups)
+    good_users = property(_refresh_good_users)
+    group_types = property(_refresh_group_types)
+    membership = property(_refresh_membership)
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import os
+import stat
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+import sh
+
+try:
+    import selinux
+
+    have_selinux = (selinux.is_selinux_enabled() == 1)
+except ImportError:
+    have_selinux = False
+
+# Paths given to a single restorecon call, well below ARG_MAX.
+RESTORECON_BATCH = 512
+
+
+def restorecon(paths):
+    """ Restores the SELinux contexts of paths and their content. """
+    if not have_selinux:
+        return
+    paths = list(paths)
+    for i in range(0, len(paths), RESTORECON_BATCH):
+        sh.restorecon('-R', '--', *paths[i:i + RESTORECON_BATCH])
+
+
+class SkelTemplate(object):
+    """
+    Content of a skeleton directory, read once and written to any number
+    of new homedirs.
+
+    Entries are created exclusively and without following symlinks, then
+    owned and given their mode through their file descriptor. The homedir
+    itself is only handed over to its owner once filled.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, mode, entries):
+        self.mode = mode
+        self.entries = entries
+
+    @classmethod
+    def load(cls, source='/etc/skel'):
+        """ Reads the skeleton directory source. """
+        entries = []
+        # Symlinked directories are not descended into, they are copied as
+        # links.
+        for dirpath, dirnames, filenames in os.walk(source):
+            relpath = os.path.relpath(dirpath, source)
+            for name in sorted(dirnames) + sorted(filenames):
+                fullname = os.path.join(dirpath, name)
+                name = os.path.normpath(os.path.join(relpath, name))
+                st = os.lstat(fullname)
+                mode = stat.S_IMODE(st.st_mode)
+                if stat.S_ISLNK(st.st_mode):
+                    entries.append((name, 'link', mode, os.readlink(fullname)))
+                elif stat.S_ISDIR(st.st_mode):
+                    entries.append((name, 'dir', mode, None))
+                elif stat.S_ISREG(st.st_mode):
+                    with open(fullname, 'rb') as skelfile:
+                        entries.append((name, 'file', mode, skelfile.read()))
+        return cls(stat.S_IMODE(os.stat(source).st_mode), entries)
+
+    def create(self, home_dir, uid, gid):
+        """ Creates home_dir from the template, owned by uid and gid. """
+        os.mkdir(home_dir, 0700)
+        for name, kind, mode, content in self.entries:
+            target = os.path.join(home_dir, name)
+            if kind == 'link':
+                os.symlink(content, target)
+                os.lchown(target, uid, gid)
+                continue
+            if kind == 'dir':
+                os.mkdir(target, 0700)
+                fd = os.open(target, os.O_RDONLY | os.O_DIRECTORY |
+                             os.O_NOFOLLOW)
+            else:
+                fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                             os.O_NOFOLLOW, 0600)
+            try:
+                while content:
+                    content = content[os.write(fd, content):]
+                os.fchown(fd, uid, gid)
+                os.fchmod(fd, mode)
+            finally:
+                os.close(fd)
+
+        fd = os.open(home_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        try:
+            os.fchown(fd, uid, gid)
+            os.fchmod(fd, self.mode)
+        finally:
+            os.close(fd)
+
+    def create_all(self, homes, workers=1):
+        """
+        Creates the (home_dir, uid, gid) homes, workers at a time, and
+        restores their SELinux contexts at once.
+        """
+        def create(home):
+            self.log.info('Creating homedir %s' % home[0])
+            self.create(*home)
+
+        try:
+            if workers > 1 and len(homes) > 1:
+                pool = ThreadPool(min(workers, len(homes)))
+                try:
+                    pool.map(create, homes)
+                finally:
+                    pool.terminate()
+            else:
+                for home in homes:
+                    create(home)
+        finally:
+            restorecon(home_dir for home_dir, uid, gid in homes
+                       if os.path.exists(home_dir))
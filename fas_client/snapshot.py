@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import pickle
+import hashlib
+import logging
+
+from collections import namedtuple
+
+from kitchen.text.converters import to_bytes
+
+from .systemutils import save_pickle
+
+# Bump whenever the content of a snapshot changes so that stale snapshots
+# are ignored instead of producing a bogus delta.
+SNAPSHOT_VERSION = 3
+
+log = logging.getLogger(__name__)
+
+UserState = namedtuple('UserState',
+                       'username ssh_key shell ssh_cmd ssh_options')
+GroupState = namedtuple('GroupState', 'id members')
+
+
+def user_state(user, account):
+    """ Returns the UserState of a FAS user given account on this host. """
+    ssh_key = user['ssh_key']
+    if ssh_key:
+        # Only track whether keys changed, not the keys themselves.
+        ssh_key = hashlib.sha1(to_bytes(ssh_key)).hexdigest()
+    return UserState(user['username'], ssh_key, account.shell,
+                     account.ssh_cmd, account.ssh_options)
+
+
+class Snapshot(object):
+    """ Accounts applied to the local system by the last successful sync. """
+
+    def __init__(self, users=None, groups=None, home=None, keys=None):
+        self.version = SNAPSHOT_VERSION
+        self.users = users or {}
+        self.groups = groups or {}
+        self.home = home
+        # Where SSH keys were installed, [global] authorized_keys.
+        self.keys = keys
+
+    @classmethod
+    def from_accounts(cls, sa, users, home, keys=None):
+        """ Builds a snapshot from ShellAccounts data and filtered users. """
+        records = sa.users
+        snap_users = dict((uid, user_state(records[uid], account))
+                          for uid, account in users.iteritems())
+        snap_groups = {}
+        for name, group in sa.groups.iteritems():
+            snap_groups[name] = GroupState(
+                group['id'], sa.membership.group_members[name])
+        return cls(snap_users, snap_groups, home, keys)
+
+    @classmethod
+    def load(cls, filename):
+        """ Returns the snapshot saved in filename or None. """
+        try:
+            with open(filename, 'rb') as snapfile:
+                snapshot = pickle.load(snapfile)
+        except (IOError, EOFError, pickle.UnpicklingError), e:
+            log.debug('Unable to read from file: %s' % e)
+            return None
+        if getattr(snapshot, 'version', None) != SNAPSHOT_VERSION:
+            log.info('Ignoring outdated snapshot %s' % filename)
+            return None
+        return snapshot
+
+    def save(self, filename):
+        """ Atomically saves the snapshot to filename. """
+        try:
+            save_pickle(filename, self)
+        except (IOError, OSError), e:
+            log.error('Unable to write to file %s: %s' % (filename, e))
+
+    def diff(self, other):
+        """ Returns the changes needed to go from this snapshot to other. """
+        return SnapshotDelta(self, other)
+
+
+class SnapshotDelta(object):
+    """ Users and groups added, removed or modified between two snapshots. """
+
+    def __init__(self, old, new):
+        self.added_users = set(new.users) - set(old.users)
+        self.removed_users = set(old.users) - set(new.users)
+        self.modified_users = set(
+            uid for uid in set(new.users) & set(old.users)
+            if new.users[uid] != old.users[uid])
+
+        self.added_groups = set(new.groups) - set(old.groups)
+        self.removed_groups = set(old.groups) - set(new.groups)
+        self.modified_groups = set(
+            name for name in set(new.groups) & set(old.groups)
+            if new.groups[name] != old.groups[name])
+
+        # Renamed users get a new homedir and must give up the old one.
+        self.renamed_users = dict(
+            (uid, old.users[uid].username) for uid in self.modified_users
+            if old.users[uid].username != new.users[uid].username)
+        self.removed_usernames = set(
+            old.users[uid].username for uid in self.removed_users)
+        self.removed_usernames.update(self.renamed_users.itervalues())
+
+    def __nonzero__(self):
+        return bool(self.added_users or self.removed_users or
+                    self.modified_users or self.added_groups or
+                    self.removed_groups or self.modified_groups)
+
+    def __str__(self):
+        return ('users: %i added, %i removed, %i modified; '
+                'groups: %i added, %i removed, %i modified' % (
+                    len(self.added_users), len(self.removed_users),
+                    len(self.modified_users), len(self.added_groups),
+                    len(self.removed_groups), len(self.modified_groups)))
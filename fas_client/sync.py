@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+# Author(s): Xavier Lamien <laxathom@fedoraproject.org>
+
+import os
+import time
+import logging
+import pickle
+
+from kitchen.text.converters import to_bytes
+
+from .systemutils import save_pickle, get_option
+from .snapshot import Snapshot, user_state
+from .lock import SyncLock
+from .metrics import metrics
+from .keyindex import INDEX, write_index
+from .lazyhome import HOME_REGISTRY
+
+
+class AccountSync(object):
+    """
+    Applies the FAS accounts of the host's groups to the local system.
+
+    The accounts applied by the last successful run are kept in a snapshot,
+    so that homedirs and SSH keys are only updated for the users that changed
+    since then.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Accounts given by the last run, keyed by uid.
+    accounts = None
+
+    def __init__(self, sa, config):
+        self.sa = sa
+        self.config = config
+        self.modefile = get_option(config, 'global', 'modefile')
+        self.snapshotfile = get_option(config, 'global', 'snapshotfile',
+                                       '/var/lib/fas/client_snapshot')
+        self.lock = SyncLock(get_option(config, 'global', 'lockfile',
+                                        '/var/lib/fas/client_sync.lock'))
+        self.textfile = get_option(config, 'global', 'metrics_textfile', None)
+        lazy_home = get_option(config, 'users', 'lazy_home', False,
+                               kind='boolean')
+        self.home_registry = None
+        if lazy_home:
+            self.home_registry = get_option(config, 'global', 'home_registry',
+                                            HOME_REGISTRY)
+        keys = get_option(config, 'global', 'authorized_keys', 'files')
+        if lazy_home and keys != 'index':
+            # Homedirs may not exist yet, and sshd needs the keys before
+            # the session creating them starts.
+            self.log.warning('lazy_home only works with authorized_keys = '
+                             'index, not writing authorized_keys files')
+            keys = 'index'
+        self.keys = keys
+        self.key_files = keys in ('files', 'both')
+        self.key_index = None
+        if keys in ('index', 'both'):
+            self.key_index = get_option(config, 'global', 'key_index', INDEX)
+
+    def load_modes(self):
+        """ Returns the saved modes of locked homedirs. """
+        try:
+            modefile = open(self.modefile, 'r')
+            modes = pickle.load(modefile)
+        except (IOError, EOFError, pickle.UnpicklingError), e:
+            modes = {}
+            self.log.debug('Unable to read from file: %s' % e)
+        else:
+            modefile.close()
+        return modes
+
+    def save_modes(self, modes):
+        """ Saves the modes of locked homedirs. """
+        try:
+            save_pickle(self.modefile, modes, mode=0644)
+        except (IOError, OSError), e:
+            self.log.debug('Unable to write to file: %s' % e)
+
+    def sync_homedirs(self, users, delta=None):
+        """
+        Creates new homedirs and locks the stale ones. In lazy mode, homedirs
+        are only recorded, they are created at their owner's first login.
+        """
+        modes = self.load_modes()
+        if self.home_registry:
+            if delta is None or delta or \
+                    not os.path.exists(self.home_registry):
+                self.write_home_registry(users)
+            stale = None if delta is None else delta.removed_usernames
+            new_modes = self.sa.remove_stale_homedirs(users, stale=stale)
+        elif delta is None:
+            self.sa.create_home_dirs(users, modes=modes)
+            new_modes = self.sa.remove_stale_homedirs(users)
+        else:
+            # Homedirs of modified users are checked too, in case they were
+            # locked after their keys could not be written.
+            new_users = delta.added_users.union(delta.modified_users)
+            self.sa.create_home_dirs(
+                dict((uid, users[uid]) for uid in new_users), modes=modes)
+            new_modes = self.sa.remove_stale_homedirs(
+                users, stale=delta.removed_usernames)
+        modes.update(new_modes)
+        self.save_modes(modes)
+
+    def write_home_registry(self, users):
+        """ Records the users whose homedir is created at first login. """
+        entries = []
+        for uid in users:
+            username = self.sa.users[uid]['username']
+            entries.append((username, '%i\t%s' % (
+                uid, to_bytes(self.sa.policy.home_dir(username)))))
+        count = write_index(self.home_registry, entries)
+        self.log.debug('Recorded %i homedirs in %s'
+                       % (count, self.home_registry))
+
+    def sync_ssh_keys(self, users, delta=None, sweep=False):
+        """
+        Installs the SSH keys of the given users, in their homedirs and/or
+        in the key index. Returns the uids whose keys were not written.
+
+        When only the index is used, the authorized_keys recorded in the SSH
+        manifest are removed. sweep removes every user's, to be done once
+        when the keys were installed elsewhere before.
+        """
+        # The index is rewritten whole, only when some account changed.
+        if self.key_index and (delta is None or delta or
+                               not os.path.exists(self.key_index)):
+            self.write_key_index(users)
+        if not self.key_files:
+            # Files written before the index was used would keep revoked
+            # keys valid.
+            if sweep:
+                self.log.info('Removing the authorized_keys of every user')
+            self.sa.remove_ssh_keys(users, written=not sweep)
+            return set()
+        if delta is not None:
+            users = dict((uid, users[uid]) for uid in
+                         delta.added_users.union(delta.modified_users))
+        return self.sa.create_ssh_keys(users)
+
+    def write_key_index(self, users):
+        """ Writes the SSH keys of every account to the key index. """
+        entries = []
+        for uid, account in users.iteritems():
+            keys = self.sa.render_ssh_keys(uid, account)
+            if keys is not None:
+                entries.append((self.sa.users[uid]['username'], keys))
+        count = write_index(self.key_index, entries)
+        self.log.debug('Wrote %i keys to %s' % (count, self.key_index))
+
+    def run(self, home=True, ssh=True, install_group=True,
+            install_passwd=True, install_shadow=True, full=False,
+            skippable=True):
+        """
+        Synchronizes the local system with FAS.
+
+        Every account is swept when full is set or when no usable snapshot
+        of the previous run exists. Returns the users with an account on
+        this host.
+
+        Runs of other processes are waited for. When one of them applied
+        everything while waiting, nothing is done and None is returned,
+        unless skippable is unset: the FAS data held in memory may be newer
+        than what it applied.
+        """
+        complete = (home and ssh and install_group and install_passwd and
+                    install_shadow)
+        return self._measured('accounts', lambda: self.lock.run(
+            lambda: self._run(home, ssh, install_group, install_passwd,
+                              install_shadow, full),
+            complete=complete, skippable=skippable))
+
+    def _measured(self, kind, sync):
+        """ Returns sync()'s result, counting its success or failure. """
+        try:
+            result = sync()
+        except Exception:
+            metrics.incr('fas_client_syncs_total', kind=kind,
+                         result='failure')
+            raise
+        else:
+            metrics.incr('fas_client_syncs_total', kind=kind,
+                         result='success')
+            metrics.set('fas_client_last_success_timestamp_seconds',
+                        time.time())
+            return result
+        finally:
+            self.export_metrics()
+
+    def export_metrics(self):
+        """ Writes the metrics file, when there is one. """
+        if self.textfile:
+            metrics.write_textfile(self.textfile)
+
+    def _run(self, home, ssh, install_group, install_passwd, install_shadow,
+             full):
+        with metrics.phase('fetch'):
+            self.sa.refresh_all()
+        with metrics.phase('filter_users'):
+            users = self.sa.filter_users()
+        metrics.set('fas_client_records', len(self.sa.users), kind='users')
+        metrics.set('fas_client_records', len(self.sa.groups), kind='groups')
+        metrics.set('fas_client_records', len(users), kind='accounts')
+
+        self.sa.make_nss_db(users, install_group=install_group,
+                            install_passwd=install_passwd,
+                            install_shadow=install_shadow)
+
+        snapshot = Snapshot.from_accounts(self.sa, users,
+                                          unicode(self.sa.policy.home_base),
+                                          self.keys)
+        previous = Snapshot.load(self.snapshotfile)
+        # Without a snapshot, where the keys were installed is unknown.
+        sweep_keys = previous is None or previous.keys != snapshot.keys
+        if full:
+            previous = None
+        if previous is not None and previous.home != snapshot.home:
+            self.log.info('Home base changed, sweeping every account')
+            previous = None
+
+        if previous is None:
+            delta = None
+            self.log.info('Full sync of %i accounts' % len(users))
+        else:
+            delta = previous.diff(snapshot)
+            self.log.info('Incremental sync, %s' % delta)
+
+        if home:
+            with metrics.phase('homedirs'):
+                self.sync_homedirs(users, delta)
+        failed = set()
+        if ssh:
+            with metrics.phase('ssh_keys'):
+                failed = self.sync_ssh_keys(users, delta, sweep=sweep_keys)
+
+        # A partial run did not apply everything the snapshot records.
+        if home and ssh:
+            # Left out, they are added again by the next run, which unlocks
+            # their homedir and retries their keys.
+            for uid in failed:
+                del snapshot.users[uid]
+            snapshot.save(self.snapshotfile)
+
+        self.accounts = users
+        return users
+
+    def update_user(self, username):
+        """
+        Applies the changes of a single user's password or SSH keys.
+
+        Only that user is fetched from FAS and only their authorized_keys
+        is rewritten. Returns False, without touching anything, when the
+        user's eligibility on this host may have changed and a full run is
+        needed instead.
+        """
+        return self._measured('user', lambda: self.lock.run(
+            lambda: self._update_user(username),
+            complete=False, skippable=False))
+
+    def _update_user(self, username):
+        if self.accounts is None:
+            return False
+        # Data past its TTL is fetched again, as at the start of full runs.
+        self.sa.refresh_all()
+        before = [uid for uid, user in self.sa.users.iteritems()
+                  if user['username'] == username]
+        had_account = any(uid in self.accounts for uid in before)
+
+        record = self.sa.refresh_user(username)
+        if record is None:
+            # Deactivated users lose their account.
+            return not had_account
+        if not before:
+            # Newly activated users may be eligible now.
+            return False
+        if record.id not in self.accounts:
+            # Group memberships did not change, still no account here.
+            return True
+
+        uid = record.id
+        account = self.accounts[uid]
+        # Groups did not change, only passwd and shadow may need an update.
+        self.sa.make_nss_db(self.accounts, group=None)
+        if self.key_index:
+            self.write_key_index(self.accounts)
+        failed = set()
+        if self.key_files:
+            failed = self.sa.create_ssh_keys({uid: account})
+
+        snapshot = Snapshot.load(self.snapshotfile)
+        if snapshot is not None:
+            if failed:
+                # Retried by the next run.
+                snapshot.users.pop(uid, None)
+            else:
+                snapshot.users[uid] = user_state(record, account)
+            snapshot.save(self.snapshotfile)
+
+        self.log.info('Updated account of %s' % username)
+        return True
@@ -20,6 +20,7 @@
 
 import os
 import logging
+import pickle
 import ConfigParser
 
 import pwd
@@ -40,7 +41,7 @@ except ImportError:
 
     have_selinux = False
 
-from sh import makedb, authconfig
+import sh
 from path import path
 
 __AUTHCONFIG__ = '/etc/sysconfig/authconfig'
@@ -65,6 +66,26 @@ def read_config(filename='./fas.conf'):
     return config
 
 
+_REQUIRED = object()
+
+
+def get_option(config, section, option, default=_REQUIRED, kind=None):
+    """
+    Returns a config value without its quotes, or converted by the
+    ConfigParser getter of kind ('int', 'float' or 'boolean'). default is
+    returned when the option or its section is missing, the error is raised
+    when there is none.
+    """
+    try:
+        if kind is None:
+            return config.get(section, option).strip('"')
+        return getattr(config, 'get' + kind)(section, option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        if default is _REQUIRED:
+            raise
+        return default
+
+
 # TODO: keep the "good_users" around for now while upgrading to new API
 def make_aliases_text(config, good_users, users, groups, temp):
     """ Creates the aliases file. """
@@ -179,7 +200,7 @@ def update_authconfig(option=None):
         print >> sys.stderr, 'ERROR: Could not write %s: %s' % (__AUTHCONFIG__, e)
         sys.exit(5)
 
-    if authconfig('--updateall').exit_code == 0:
+    if sh.authconfig('--updateall').exit_code == 0:
         temp.rmtree()
         return True
 
@@ -208,6 +229,35 @@ def chown(arg, dir_name, files):
         os.chown(os.path.join(dir_name, file), arg[0], arg[1])
 
 
+def atomic_write(filename, write, mode=0600):
+    """
+    Atomically replaces filename with what write(fileobj) writes: the file
+    is staged next to it, synced and renamed over it, so that readers see
+    either the old or the new content, never a partial one.
+    """
+    dirname = os.path.dirname(filename) or '.'
+    fd, staged = tempfile.mkstemp(prefix='.%s-' % os.path.basename(filename),
+                                  dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as stage:
+            os.fchmod(stage.fileno(), mode)
+            write(stage)
+            stage.flush()
+            os.fsync(stage.fileno())
+        os.rename(staged, filename)
+    except Exception:
+        if os.path.exists(staged):
+            os.remove(staged)
+        raise
+
+
+def save_pickle(filename, obj, mode=0600):
+    """ Atomically replaces filename with the pickle of obj. """
+    atomic_write(filename,
+                 lambda stage: pickle.dump(obj, stage, pickle.HIGHEST_PROTOCOL),
+                 mode)
+
+
 def drop_privs(pw):
     # initgroups is only in python >= 2.7
     # os.initgroups(pw.pw_name, pw.pw_gid)
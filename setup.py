@@ -61,7 +61,9 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'fas_client = fas_client.main:main'
+            'fas_client = fas_client.main:main',
+            'fas_client_authorized_keys = fas_client.keyindex:main',
+            'fas_client_pam_home = fas_client.lazyhome:main',
         ],
         'fas.client': [
             'info = fas_client.infos:Info',
@@ -70,6 +72,7 @@ setup(
             'enable-account = fas_client.accountsetup:Enable',
             'disable-account = fas_client.accountsetup:Disable',
             'daemonize = fas_client.daemonize:Daemonize',
+            'authorized-keys = fas_client.authorizedkeys:AuthorizedKeys',
         ],
     },
 